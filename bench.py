@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Benchmarks Cassium's dispatch by feeding it IRC traffic in memory.
+
+Lines are either generated synthetically or replayed from the Log plugin's
+chat logs (or its console output), and fed to Cassium's lineReceived
+through an in-memory transport. The report covers events per second,
+latency per signal type and memory growth for the chosen set of plugins.
+"""
+import gc
+import logging
+from optparse import OptionParser
+import random
+import re
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from twisted.internet import reactor
+from twisted.test.proto_helpers import StringTransport
+
+from cassium import chatlog
+from cassium.cassium import Cassium
+
+# Signal types by IRC command
+SIGNALS = {
+    'PRIVMSG': 'msg',
+    'JOIN': 'join',
+    'PART': 'leave',
+    'QUIT': 'quit',
+    'NICK': 'nick',
+    'TOPIC': 'topic',
+    'KICK': 'kick',
+}
+
+WORDS = ('the quick brown fox jumps over the lazy dog hello world foo bar '
+    'baz lorem ipsum dolor sit amet').split()
+
+class BenchConfig(object):
+    """A stand-in for the configuration module."""
+
+    nick = 'Cassium'
+    realname = 'A Cassium IRC Bot'
+    admins = []
+    channels = []
+    tick_interval = None
+    autosave_interval = None
+    # Don't let the send queue merge or throttle replies away
+    send_separator = None
+    # Measure dispatch rather than flood protection
+    flood_rate = None
+    flood_channel_rate = None
+    flood_backlog = None
+    mass_rate = None
+
+
+def synthetic(count, channels, users, seed):
+    """Generates a reproducible mix of IRC traffic."""
+    rng = random.Random(seed)
+    chans = ['#chan%d' % i for i in range(channels)]
+    nicks = ['user%d' % i for i in range(users)]
+    for i in range(count):
+        index = rng.randrange(users)
+        nick = nicks[index]
+        prefix = '%s!%s@host%d.example.com' % (nick, nick, index)
+        channel = rng.choice(chans)
+        r = rng.random()
+        if r < .8:
+            if rng.random() < .05:
+                text = '!hello'
+            else:
+                text = ' '.join(rng.choice(WORDS)
+                    for j in range(rng.randint(1, 12)))
+            yield ':%s PRIVMSG %s :%s' % (prefix, channel, text)
+        elif r < .85:
+            yield ':%s JOIN %s' % (prefix, channel)
+        elif r < .9:
+            yield ':%s PART %s :bye' % (prefix, channel)
+        elif r < .93:
+            yield ':%s QUIT :Quit: bye' % prefix
+        elif r < .96:
+            nicks[index] = 'user%d_%d' % (index, i)
+            yield ':%s NICK :%s' % (prefix, nicks[index])
+        elif r < .98:
+            yield ':%s PRIVMSG %s :\x01ACTION waves\x01' % (prefix, channel)
+        elif r < .99:
+            yield ':%s TOPIC %s :%s' % (prefix, channel, rng.choice(WORDS))
+        else:
+            yield ':%s KICK %s %s :out' % (prefix, channel,
+                rng.choice(nicks))
+
+
+# IRC lines for each type of chat log record, filled in with the record's
+# fields and args
+RECORD_TEMPLATES = {
+    'msg': ':%(user)s PRIVMSG %(channel)s :%(0)s',
+    'action': ':%(user)s PRIVMSG %(channel)s :\x01ACTION %(0)s\x01',
+    'join': ':%(user)s JOIN %(channel)s',
+    'leave': ':%(user)s PART %(channel)s',
+    'quit': ':%(user)s QUIT :%(0)s',
+    'kick': ':%(user)s KICK %(channel)s %(0)s :%(1)s',
+    'topic': ':%(user)s TOPIC %(channel)s :%(0)s',
+    'nick': ':%(user)s NICK :%(0)s',
+}
+
+def is_chatlog(path):
+    """Returns whether a file is a chat log, judging by its first line."""
+    if path.endswith('.gz'):
+        return True
+    with open(path) as f:
+        fields = f.readline().split('\t')
+    try:
+        float(fields[0])
+    except ValueError:
+        return False
+    return len(fields) >= 4
+
+
+def replay_chatlog(path):
+    """Converts one of the Log plugin's chat logs back into IRC lines."""
+    for record in chatlog.read(path):
+        template = RECORD_TEMPLATES.get(record.type)
+        if template is None:
+            continue
+        fields = dict((str(i), arg) for i, arg in enumerate(record.args))
+        fields['channel'] = record.channel
+        fields['user'] = record.user
+        if '!' not in record.user:
+            fields['user'] += '!log@replay'
+        try:
+            yield template % fields
+        except KeyError:
+            # Too few args for the record's type
+            continue
+
+
+# Patterns for the Log plugin's console output, and templates for the IRC lines
+# they came from, filled in with the named groups and the line's channel.
+# Lines Cassium logged about itself have no template.
+LOG_PATTERNS = [
+    (re.compile(r'^<(?P<nick>\S+)> (?P<text>.*)$'),
+        ':%(nick)s!log@replay PRIVMSG %(channel)s :%(text)s'),
+    (re.compile(r'^-\*- (?:Joined|Left|Kicked from) '), None),
+    (re.compile(r'^-\*- (?P<nick>\S+) joined \S+$'),
+        ':%(nick)s!log@replay JOIN %(channel)s'),
+    (re.compile(r'^-\*- (?P<nick>\S+) left \S+$'),
+        ':%(nick)s!log@replay PART %(channel)s'),
+    (re.compile(r'^-\*- (?P<nick>\S+) kicked (?P<kickee>\S+) from \S+ '
+        r'\((?P<reason>.*)\)$'),
+        ':%(nick)s!log@replay KICK %(channel)s %(kickee)s :%(reason)s'),
+    (re.compile(r"^-\*- (?P<nick>\S+) set \S+'s topic to: (?P<topic>.*)$"),
+        ':%(nick)s!log@replay TOPIC %(channel)s :%(topic)s'),
+    (re.compile(r'^-\*- (?P<nick>\S+) quit \((?P<message>.*)\)$'),
+        ':%(nick)s!log@replay QUIT :%(message)s'),
+    (re.compile(r'^-\*- (?P<nick>\S+) is now known as (?P<newname>\S+)$'),
+        ':%(nick)s!log@replay NICK :%(newname)s'),
+    # Anything else on a channel is an action
+    (re.compile(r'^-\*- (?P<nick>\S+) (?P<action>.*)$'),
+        ':%(nick)s!log@replay PRIVMSG %(channel)s :\x01ACTION %(action)s\x01'),
+]
+# The Log plugin's channel column, followed by the logged text
+LOG_LINE = re.compile(r'(?:^|\s)(?P<channel>[#&]\S*): (?P<text>.*)$|'
+    r'\s{2,}(?P<global>-\*- .*)$')
+
+def replay(path):
+    """Converts the Log plugin's chat logs or console output into IRC lines."""
+    if is_chatlog(path):
+        for line in replay_chatlog(path):
+            yield line
+        return
+    with open(path) as f:
+        for line in f:
+            match = LOG_LINE.search(line.rstrip('\r\n'))
+            if match is None:
+                continue
+            channel = match.group('channel')
+            text = match.group('text') or match.group('global')
+            for pattern, template in LOG_PATTERNS:
+                found = pattern.match(text)
+                if found:
+                    if template is not None and (channel or
+                            '%(channel)s' not in template):
+                        fields = found.groupdict()
+                        fields['channel'] = channel
+                        yield template % fields
+                    break
+
+
+def signal_type(line):
+    """Gets the signal type an IRC line will trigger."""
+    command = line.split(' ', 2)[1]
+    if command == 'PRIVMSG' and '\x01ACTION' in line:
+        return 'action'
+    return SIGNALS.get(command, command)
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def memory():
+    """Returns the peak resident set size in kilobytes, if available."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark(cassium, transport, lines, warmup):
+    """
+    Feeds lines to Cassium.
+
+    Returns the timings of each line by signal type, and the total time
+    taken, leaving out the first `warmup` lines.
+    """
+    timings = {}
+    begun = time.time()
+    for i, line in enumerate(lines):
+        if i == warmup:
+            timings.clear()
+            begun = time.time()
+        started = time.time()
+        cassium.lineReceived(line)
+        timings.setdefault(signal_type(line), []).append(
+            time.time() - started)
+        # Keep the transport's buffer from skewing memory growth
+        if i % 1000 == 0:
+            transport.clear()
+    return timings, time.time() - begun
+
+
+def report(timings, elapsed, rss, objects):
+    total = sum(len(samples) for samples in timings.values())
+    print('%d events in %.3fs (%.0f events/sec)' %
+        (total, elapsed, total / elapsed if elapsed else 0))
+    print('%-8s %8s %10s %10s %10s' % ('signal', 'count', 'mean', 'p50',
+        'p99'))
+    for signaltype, samples in sorted(timings.items()):
+        samples.sort()
+        print('%-8s %8d %8.3fms %8.3fms %8.3fms' % (signaltype, len(samples),
+            sum(samples) / len(samples) * 1000,
+            percentile(samples, .5) * 1000,
+            percentile(samples, .99) * 1000))
+    print('memory: peak RSS +%d KB, %+d objects' % (rss, objects))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [logfile]')
+    parser.add_option('-n', '--lines', type='int', default=100000,
+        help='number of synthetic lines to generate')
+    parser.add_option('-c', '--channels', type='int', default=20,
+        help='number of synthetic channels')
+    parser.add_option('-u', '--users', type='int', default=500,
+        help='number of synthetic users')
+    parser.add_option('-s', '--seed', type='int', default=0,
+        help='seed for synthetic traffic')
+    parser.add_option('-w', '--warmup', type='int', default=1000,
+        help='number of lines to feed before measuring')
+    parser.add_option('-p', '--plugins',
+        help='comma-separated plugin modules to load instead of plugins/')
+    parser.add_option('--profile', action='store_true',
+        help='enable per-handler profiling and report it')
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    config = BenchConfig()
+    config.profile = options.profile
+    if options.plugins:
+        config.plugins = options.plugins.split(',')
+    if args:
+        lines = list(replay(args[0]))
+    else:
+        lines = list(synthetic(options.lines, options.channels,
+            options.users, options.seed))
+    channels = sorted(set(line.split(' ')[2] for line in lines
+        if line.split(' ')[2].startswith('#')))
+
+    def run():
+        try:
+            cassium = Cassium(config)
+            transport = StringTransport()
+            cassium.makeConnection(transport)
+            cassium.lineReceived(':bench 001 Cassium :Welcome')
+            for channel in channels:
+                cassium.lineReceived(':Cassium!cassium@bench JOIN ' + channel)
+            gc.collect()
+            rss, objects = memory(), len(gc.get_objects())
+            timings, elapsed = benchmark(cassium, transport, lines,
+                options.warmup)
+            gc.collect()
+            report(timings, elapsed, memory() - rss,
+                len(gc.get_objects()) - objects)
+            profiler = cassium.manager.profiler
+            if profiler is not None:
+                print('')
+                for stats in profiler.top():
+                    print(stats.summary())
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
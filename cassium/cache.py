@@ -0,0 +1,339 @@
+from collections import OrderedDict
+from functools import partial
+import logging
+import os
+from threading import Lock, RLock
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from twisted.internet import defer
+
+from persist import atomic_write
+
+__all__ = ['LRUCache', 'Cache', 'get_cache', 'memoize', 'save_caches']
+
+log = logging.getLogger(__name__)
+
+# Marks a missing item
+MISSING = object()
+
+class LRUCache(object):
+    """
+    A dict-like mapping holding at most `limit` items.
+
+    Getting or setting an item makes it the most recently used, and adding
+    an item beyond the limit evicts the least recently used one.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.items = OrderedDict()
+        self.evicted = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.limit:
+            self.items.popitem(last=False)
+            self.evicted += 1
+
+    def __delitem__(self, key):
+        del self.items[key]
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+
+class Cache(object):
+    """
+    A named, thread-safe cache shared by plugins (see get_cache()).
+
+    It holds at most `limit` items, evicting the least recently used, and
+    items expire `ttl` seconds after they're set, unless ttl is None. With
+    `persist` set, the cache is saved with plugin data and loaded again on
+    restart; otherwise it starts out empty. Hits, misses and evictions are
+    counted.
+
+    A Cache pickles as a reference to its name, so one kept in a plugin's
+    attributes isn't saved with the plugin's data, and the plugin gets the
+    same shared cache back when its data is loaded.
+    """
+
+    def __init__(self, name, limit=1000, ttl=None, persist=False):
+        self.name = name
+        self.limit = limit
+        self.ttl = ttl
+        self.persist = persist
+        self.items = OrderedDict()  # Key -> (expiry time or None, value)
+        self.lock = RLock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+        if persist:
+            self.load()
+
+    def get(self, key, default=None):
+        """Gets an item, or `default` if it's missing or expired."""
+        with self.lock:
+            try:
+                expiry, value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expiry is not None and expiry <= time.time():
+                self.expired += 1
+                self.misses += 1
+                return default
+            self.items[key] = (expiry, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=MISSING):
+        """
+        Sets an item, which expires after `ttl` seconds if given, or the
+        cache's ttl otherwise.
+        """
+        if ttl is MISSING:
+            ttl = self.ttl
+        expiry = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expiry, value)
+            while len(self.items) > self.limit:
+                self.items.popitem(last=False)
+                self.evicted += 1
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    __setitem__ = set
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.items[key]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            expiry, value = self.items.pop(key, (None, default))
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            return entry is not None and (entry[0] is None or
+                entry[0] > time.time())
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def prune(self):
+        """Drops every expired item."""
+        now = time.time()
+        with self.lock:
+            for key, (expiry, value) in list(self.items.items()):
+                if expiry is not None and expiry <= now:
+                    del self.items[key]
+                    self.expired += 1
+
+    def path(self):
+        return os.path.join('save', 'cache',
+            self.name.replace(os.path.sep, '_') + '.pck')
+
+    def load(self):
+        """Loads the items saved by save(), if any."""
+        path = self.path()
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                items = pickle.load(f)
+        except Exception:
+            log.exception('failed to load cache ' + self.name)
+            return
+        with self.lock:
+            self.items.update(items)
+        self.prune()
+
+    def save(self):
+        """Writes the cache's unexpired items. Returns the bytes written."""
+        self.prune()
+        with self.lock:
+            data = pickle.dumps(list(self.items.items()),
+                pickle.HIGHEST_PROTOCOL)
+        path = self.path()
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        atomic_write(path, data)
+        return len(data)
+
+    def stats(self):
+        """Returns a dict of the cache's size and counters."""
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'size': len(self.items),
+            'limit': self.limit,
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': 100. * self.hits / lookups if lookups else 0.,
+            'evicted': self.evicted,
+            'expired': self.expired,
+        }
+
+    def __reduce__(self):
+        return (get_cache, (self.name, self.limit, self.ttl, self.persist))
+
+    def __repr__(self):
+        return '<Cache %s: %d items>' % (self.name, len(self.items))
+
+
+# Shared caches by name, so reloaded plugins keep using theirs
+caches = {}
+caches_lock = Lock()
+
+def get_cache(name, limit=1000, ttl=None, persist=False):
+    """
+    Gets the cache with the given name, creating it if need be. An existing
+    cache takes on the given limit and ttl.
+    """
+    with caches_lock:
+        cache = caches.get(name)
+        if cache is None:
+            cache = caches[name] = Cache(name, limit, ttl, persist)
+        else:
+            cache.limit = limit
+            cache.ttl = ttl
+            cache.persist = cache.persist or persist
+        return cache
+
+def save_caches():
+    """Saves every persistent cache. Returns the bytes written."""
+    total = 0
+    for cache in list(caches.values()):
+        if cache.persist:
+            try:
+                total += cache.save()
+            except (IOError, OSError):
+                log.exception('failed to save cache ' + cache.name)
+    return total
+
+
+class Memoized(object):
+    """
+    A function whose results are kept in a cache, keyed by its arguments.
+
+    Unless the cache is named, a function's results are cached under its
+    module and name, and a method's under its class too, so methods of the
+    same name in different classes don't share results. As a method, its
+    instance isn't part of the key, so a plugin's results survive the plugin
+    being reloaded. Results that are Deferreds are cached once they succeed.
+    """
+
+    def __init__(self, function, name, limit, ttl, persist):
+        self.function = function
+        self.name = name
+        self.options = (limit, ttl, persist)
+        self.caches = {}    # Class defining the method, or None -> Cache
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+
+    def get_cache(self, owner):
+        """Gets the cache for calls through a class, or None if unbound."""
+        cache = self.caches.get(owner)
+        if cache is None:
+            if self.name is not None:
+                name = self.name
+            elif owner is None:
+                name = '%s.%s' % (self.function.__module__, self.__name__)
+            else:
+                name = '%s.%s.%s' % (owner.__module__, owner.__name__,
+                    self.__name__)
+            cache = self.caches[owner] = get_cache(name, *self.options)
+        return cache
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # Subclasses share the cache of the class that defines the method
+        for cls in owner.__mro__:
+            if cls.__dict__.get(self.__name__) is self:
+                owner = cls
+                break
+        return partial(self.call, self.get_cache(owner), (instance,))
+
+    def __call__(self, *args, **kwargs):
+        return self.call(self.get_cache(None), (), *args, **kwargs)
+
+    @property
+    def cache(self):
+        """The cache of calls made to the function directly."""
+        return self.get_cache(None)
+
+    def call(self, cache, bound, *args, **kwargs):
+        if kwargs:
+            key = (args, tuple(sorted(kwargs.items())))
+        else:
+            key = args
+        entry = cache.get(key, MISSING)
+        if entry is not MISSING:
+            deferred, value = entry
+            return defer.succeed(value) if deferred else value
+        result = self.function(*(bound + args), **kwargs)
+        if isinstance(result, defer.Deferred):
+            def store(value):
+                cache.set(key, (True, value))
+                return value
+            result.addCallback(store)
+        else:
+            cache.set(key, (False, result))
+        return result
+
+
+def memoize(name=None, limit=1000, ttl=None, persist=False):
+    """
+    Caches a function's results, in the named cache if given, or one named
+    after the function (and, for a method, its class) otherwise. Arguments
+    must be hashable:
+
+        @memoize(ttl=600)
+        def lookup(self, city):
+            ...
+    """
+    def decorate(function):
+        return Memoized(function, name, limit, ttl, persist)
+    return decorate
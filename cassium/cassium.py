@@ -1,111 +1,166 @@
-import glob
+from collections import deque
+from functools import partial
 import logging
 import os
 import pprint
 import re
 import sys
 from threading import Timer
-import traceback
-from inspect import isclass
+import time
+from types import GeneratorType
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from twisted.internet import protocol, reactor
-from twisted.internet.task import LoopingCall
+from twisted.internet import defer, protocol, reactor
+from twisted.python.failure import Failure
 from twisted.words.protocols.irc import IRCClient
 
+from cache import caches
+from chatlog import close_chatlogs
+from ingress import Ingress
+from manager import PluginManager
+from outbound import SendQueue
 from plugin import *
-
-__all__ = ['Cassium', 'CassiumFactory']
+from plugin import run_blocking
+from state import ChannelState, irc_lower
+
+__all__ = ['Cassium', 'CassiumFactory', 'NetworkConfig']
+
+def timeout(deferred, seconds, message):
+    """
+    Returns a Deferred that fires with the given Deferred's result, or fails
+    with TimeoutError if that takes longer than the given number of seconds.
+
+    A result that arrives after the timeout is discarded.
+    """
+    result = defer.Deferred()
+    def expire():
+        result.errback(defer.TimeoutError(message))
+    call = reactor.callLater(seconds, expire)
+    def done(outcome):
+        if call.active():
+            call.cancel()
+            result.callback(outcome)
+    deferred.addBoth(done)
+    return result
 
 class Cassium(IRCClient):
     """Cassium's main class."""
 
-    def __init__(self, config):
-        """Initialize Cassium with a configuration module."""
+    def __init__(self, config, manager=None):
+        """
+        Initialize Cassium with a configuration module.
+
+        Plugins are taken from the given PluginManager, which may be shared
+        with other connections. If none is given, one is created.
+        """
         self.config = config
         self.log = logging.getLogger(__name__)
+        if manager is None:
+            manager = PluginManager(config, [Control()])
+        self.manager = manager
+        if getattr(config, 'watch_plugins', False):
+            manager.watch(getattr(config, 'watch_interval', 2.))
+        # Identifies this connection's network to plugins
+        self.network = getattr(config, 'network', None)
         # Set up for IRC
         self.nickname = config.nick
         self.realname = config.realname
         self.username = 'A Cassium IRC Bot'
         self.versionName = 'Cassium'
         self.channels = set()
-        # Import plugins
-        self.plugins = []
-        self.load_plugins_recursively('plugins')
-        self.builtin_plugins = [Control()]
-        # Start ticking
-        tick_timer = LoopingCall(self.tick)
-        tick_timer.start(10.)
+        # Shared by every Query until the set of channels changes
+        self.channel_snapshot = frozenset()
+        # Who is in each channel, shared by every Query
+        self.state = ChannelState()
+        # Responses waiting on Deferreds, keyed by default target
+        self.pending = {}
+        # Rate-limited queue for messages, notices and actions
+        self.outbound = SendQueue(self.deliver,
+            rate=getattr(config, 'send_rate', 1.),
+            burst=getattr(config, 'send_burst', 5),
+            target_rate=getattr(config, 'send_target_rate', .5),
+            target_burst=getattr(config, 'send_target_burst', 3),
+            limit=getattr(config, 'send_queue_limit', 100),
+            separator=getattr(config, 'send_separator', ' | '))
+        # Limits which incoming events are signalled, under floods
+        self.ingress = Ingress(self.signal_mass,
+            lambda: self.outbound.depth,
+            source_rate=getattr(config, 'flood_rate', 2.),
+            source_burst=getattr(config, 'flood_burst', 10),
+            channel_rate=getattr(config, 'flood_channel_rate', 20.),
+            channel_burst=getattr(config, 'flood_channel_burst', 50),
+            ignore_time=getattr(config, 'flood_ignore_time', 60.),
+            limit=getattr(config, 'flood_limit', 10000),
+            backlog=getattr(config, 'flood_backlog', 500),
+            mass_rate=getattr(config, 'mass_rate', 5.),
+            mass_burst=getattr(config, 'mass_burst', 20),
+            mass_window=getattr(config, 'mass_window', 1.))
+        # How each of a Response's values is carried out, in flush order
+        self.actions = (
+            ('_log', self.apply_log),
+            ('_kick', self.apply_kicks),
+            ('_topic', self.apply_topics),
+            ('_nick', self.setNick),
+            ('_join', partial(self.apply_each, self.join)),
+            ('_leave', partial(self.apply_each, self.leave)),
+            ('_mode', partial(self.apply_each, self.mode)),
+            # Lines of text go through the rate-limited send queue
+            ('_notice', partial(self.apply_each,
+                partial(self.outbound.put, 'notice'))),
+            ('_me', partial(self.apply_each,
+                partial(self.outbound.put, 'me'))),
+            ('_msg', partial(self.apply_each,
+                partial(self.outbound.put, 'msg'))),
+        )
     
-    def load_plugins_recursively(self, directory):
-        """
-        Recursively loads or reloads all plugins in the given directory.
-        
-        The plugins are always loaded in alphabetical order.
-        """
-        for node in sorted(glob.iglob(os.path.join(directory, '*'))):
-            # Recurse into directories
-            if os.path.isdir(node):
-                self.load_plugins_recursively(node)
-            # Load plugins found in files
-            elif node.endswith('.py'):
-                # Don't load __init__.py
-                if os.path.split(node)[1] != '__init__.py':
-                    # Convert filesystem path to dot-delimited path
-                    path = os.path.splitext(node)[0].replace(os.path.sep, '.')
-                    self.load_plugins_from_path(path)
-
-    def load_plugins_from_path(self, path):
-        """
-        Loads or reloads the plugin(s) at the given path.
-        
-        If the path points to a module, all plugins in the given module are
-        loaded. If the path points to a specific plugin within a module, that
-        plugin is loaded on its own.
-        """
-        this_plugin = __import__(path)
-        # Navigate to the given path
-        for component in path.split('.')[1:]:
-            this_plugin = getattr(this_plugin, component)
-        # Find subclasses of Plugin and load them
-        reload(this_plugin)
-        loaded_nothing = True
-        for attr in dir(this_plugin):
-            this_attr = getattr(this_plugin, attr)
-            if (isclass(this_attr) and issubclass(this_attr, Plugin) and
-                    this_attr is not Plugin):
-                loaded_nothing = False
-                self.load_plugin(plugin=this_attr())
-        if loaded_nothing:
-            self.log.warn('no plugins were found in the module ' + path)
-
-    def load_plugin(self, plugin):
-        """Loads or reloads a plugin instance."""
-        name = plugin.fqn()
-        # Insert logger into plugin
-        plugin.log = logging.getLogger(name)
-        # Search for an existing copy of the plugin
-        for i, existing_plugin in enumerate(self.plugins):
-            if name == existing_plugin.fqn():
-                self.plugins[i] = plugin
-                self.log.info('reloaded ' + name)
-                return
-        # No existing copy found
-        self.plugins.append(plugin)
-        self.log.info('imported ' + name)
-
     def add_channel(self, channel):
-        self.channels.add(channel)
+        if channel not in self.channels:
+            self.channels.add(channel)
+            self.channel_snapshot = frozenset(self.channels)
 
     def remove_channel(self, channel):
         try:
             self.channels.remove(channel)
         except KeyError:
             self.log.warn('attempted to remove a channel I hadn\'t joined')
+        else:
+            self.channel_snapshot = frozenset(self.channels)
+
+    def connectionMade(self):
+        """Called when the connection to the IRC server is made."""
+        IRCClient.connectionMade(self)
+        # Ticks are shared by every network, so only the first starts them
+        self.manager.start_ticking()
+
+    def connectionLost(self, reason):
+        """Called when the connection to the IRC server is lost."""
+        IRCClient.connectionLost(self, reason)
+        if self in self.manager.connections:
+            self.manager.connections.remove(self)
+        self.outbound.stop()
+        self.ingress.stop()
+
+    def make_query(self, signaltype, **kwargs):
+        """Creates a Query for a signal, sharing the current channels."""
+        query = Query(self.channel_snapshot, signaltype, **kwargs)
+        query.network = self.network
+        query.state = self.state
+        query.history = self.manager.history
+        return query
+
+    def admit(self, query):
+        """Returns whether to signal a message or action, given floods."""
+        return (query.nick in self.config.admins or
+            self.ingress.admit(query.user, query.channel))
+
+    def remember(self, signaltype, user, channel, text):
+        """Adds a line said in a channel to the history index."""
+        if self.manager.history is not None and channel[:1] in '#&':
+            self.manager.history.add(time.time(), self.network, channel,
+                user.split('!', 1)[0], signaltype, text)
 
     def signedOn(self):
         """Called when Cassium successfully connects to the IRC server."""
@@ -113,31 +168,42 @@ class Cassium(IRCClient):
                 self.msg('NickServ', 'IDENTIFY ' + self.config.password)
         for channel in self.config.channels:
             self.join(channel)
-        self.signal(Query(self.channels, 'signedon'), Response(None))
+        self.manager.connections.append(self)
+        self.manager.scheduler.resume()
+        self.manager.signedon()
+        self.signal(self.make_query('signedon'), Response(None))
 
     def joined(self, channel):
         """Called when Cassium joins a channel."""
         self.add_channel(channel)
-        query = Query(self.channels, 'ijoin', channel=channel)
+        self.state._joined(channel)
+        # NAMES is sent on joining, but only WHO gives everyone's host. It
+        # goes through the send queue so joining many channels can't flood
+        if getattr(self.config, 'who_on_join', True):
+            self.outbound.put('who', channel, '')
+        query = self.make_query('ijoin', channel=channel)
         self.signal(query, Response(channel))
 
     def left(self, channel):
         """Called when Cassium leaves a channel."""
         self.remove_channel(channel)
-        query = Query(self.channels, 'ileft', channel=channel)
+        query = self.make_query('ileft', channel=channel)
         self.signal(query, Response(None))
+        self.state._left(channel)
 
     def kickedFrom(self, channel, kicker, message):
         """Called when Cassium is kicked from a channel."""
         self.remove_channel(channel)
-        query = Query(self.channels, 'ikick', channel=channel, user=kicker,
+        query = self.make_query('ikick', channel=channel, user=kicker,
             message=message)
         self.signal(query, Response(kicker))
+        self.state._left(channel)
 
     def nickChanged(self, nick):
         """Called when Cassium's nickname is changed."""
-        query = Query(self.channels, 'inick', oldname=self.nickname,
+        query = self.make_query('inick', oldname=self.nickname,
             newname=nick)
+        self.state._user_renamed(self.nickname, nick)
         self.nickname = nick
         self.signal(query, Response(None))
 
@@ -145,113 +211,253 @@ class Cassium(IRCClient):
         """Called when a user sends a message to Cassium or a channel."""
         # See the comment in Query on ValueError
         try:
-            query = Query(self.channels, 'msg', user=user, channel=channel,
+            query = self.make_query('msg', user=user, channel=channel,
                 message=message)
         except ValueError:
             return
+        self.state._seen(user)
+        if not self.admit(query):
+            return
         # Handles private messages
         target = query.nick
         if any(c in channel for c in '#&'):
             target = channel
         self.signal(query, Response(target))
+        # Indexed afterward, so searches don't find their own command
+        self.remember('msg', user, channel, message)
 
     def userJoined(self, user, channel):
         """Called when a user joins a channel."""
-        query = Query(self.channels, 'join', user=user, channel=channel)
+        query = self.make_query('join', user=user, channel=channel)
         self.signal(query, Response(channel))
 
     def userLeft(self, user, channel):
         """Called when a user leaves a channel."""
-        query = Query(self.channels, 'leave', user=user, channel=channel)
+        query = self.make_query('leave', user=user, channel=channel)
         self.signal(query, Response(channel))
+        self.state._user_left(user, channel)
 
     def userQuit(self, user, message):
         """Called when a user quits the server."""
-        query = Query(self.channels, 'quit', user=user, message=message)
-        self.signal(query, Response(None))
+        if not self.ingress.gather('quit',
+                self.state.channels_of(user) or (None,), user, message):
+            query = self.make_query('quit', user=user, message=message)
+            self.signal(query, Response(None))
+        self.state._user_quit(user)
 
     def userKicked(self, kickee, channel, kicker, message):
         """Called when a user is kicked from a channel."""
-        query = Query(self.channels, 'kick', kickee=kickee, channel=channel,
+        query = self.make_query('kick', kickee=kickee, channel=channel,
             kicker=kicker, message=message)
         self.signal(query, Response(channel))
+        self.state._user_left(kickee, channel)
 
     def action(self, user, channel, message):
         """Called when a user performs an action."""
-        query = Query(self.channels, 'action', user=user, channel=channel,
+        self.state._seen(user)
+        query = self.make_query('action', user=user, channel=channel,
             message=message)
+        if not self.admit(query):
+            return
+        self.remember('action', user, channel, message)
         # TODO: determine whether IRCClient supports private message actions
         self.signal(query, Response(channel or user))
 
     def topicUpdated(self, user, channel, topic):
         """Called when a channel's topic is updated."""
-        query = Query(self.channels, 'topic', user=user, channel=channel,
+        query = self.make_query('topic', user=user, channel=channel,
             topic=topic)
+        self.remember('topic', user, channel, topic)
         self.signal(query, Response(channel))
 
     def userRenamed(self, oldname, newname):
         """Called when a user changes their nickname."""
-        query = Query(self.channels, 'nick', oldname=oldname, newname=newname)
+        self.state._user_renamed(oldname, newname)
+        query = self.make_query('nick', oldname=oldname, newname=newname)
         self.signal(query, Response(newname))
 
+    def irc_JOIN(self, prefix, params):
+        """Called when anyone joins a channel."""
+        # Twisted passes userJoined only the nick, so track joins here
+        nick = prefix.split('!')[0]
+        if irc_lower(nick) != irc_lower(self.nickname):
+            self.state._user_joined(prefix, params[-1])
+            if self.ingress.gather('join', (params[-1],), nick):
+                return
+        IRCClient.irc_JOIN(self, prefix, params)
+
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        """Called with part of a channel's member list."""
+        self.state._names_reply(params[2], params[3])
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        """Called once a channel's member list is complete."""
+        self.state._names_end(params[1])
+
+    def irc_RPL_WHOREPLY(self, prefix, params):
+        """Called with a channel member's user and host."""
+        self.state._who_reply(params[1], params[2], params[3], params[5])
+
     def tick(self):
-        self.signal(Query(self.channels, 'tick'), Response(None))
+        """Signals a tick, for the manager."""
+        self.signal(self.make_query('tick'), Response(None))
+
+    def run_job(self, job):
+        """Calls a scheduled job's handler with a Query and Response."""
+        self.dispatch(self.make_query('job'), Response(None), [(job, False)])
+
+    def signal_mass(self, signaltype, channel, users, message):
+        """Signals a batch of joins or quits gathered by the ingress."""
+        fields = {'users': tuple(users)}
+        if channel is not None:
+            fields['channel'] = channel
+        if message is not None:
+            fields['message'] = message
+        self.signal(self.make_query(signaltype, **fields), Response(channel))
 
     def signal(self, query, response):
         """Called by the above signals to relay the event to each plugin."""
         # Don't respond to *Serv
         if hasattr(query, 'nick') and query.nick.endswith('Serv'):
             return
-        # Convenience
-        signaltype = query.type
+        if query.type == 'msg':
+            handlers = self.manager.triggers.match(query.message)
+        else:
+            handlers = self.manager.handlers.get(query.type, ())
+        self.dispatch(query, response, handlers)
+
+    def dispatch(self, query, response, handlers):
+        """
+        Calls each of the given (method, builtin) handlers, and flushes the
+        Response once they're done. A handler that raises is reported, and
+        the others still run.
+        """
+        deferreds = []
+        for method, builtin in handlers:
+            try:
+                if getattr(method, 'blocking', False):
+                    result = run_blocking(method, query, response)
+                else:
+                    # If this is a builtin plugin, pass it Cassium
+                    result = method(query, self if builtin else response)
+                    # Drive bare generators as if they were inlineCallbacks
+                    if isinstance(result, GeneratorType):
+                        result = defer.inlineCallbacks(
+                            lambda gen=result: gen)()
+            except Exception:
+                self.error(response)
+                continue
+            if isinstance(result, defer.Deferred):
+                deferreds.append(self.expire(result, method))
+        self.finish(response, deferreds)
+
+    def expire(self, deferred, method):
+        """
+        Applies a handler's timeout to the Deferred it produced.
+
+        The timeout is taken from the @blocking decorator if given, and from
+        the plugin_timeout configuration value otherwise.
+        """
+        seconds = (getattr(method, 'timeout', None) or
+            getattr(self.config, 'plugin_timeout', 30.))
+        return timeout(deferred, seconds, '%s.%s took longer than %s seconds'
+            % (method.__self__.fqn(), method.__name__, seconds))
+
+    def finish(self, response, deferreds):
+        """
+        Flushes a Response once all of the given Deferreds have fired.
+
+        The Deferreds run concurrently, so an event waits only as long as its
+        slowest handler. Responses are flushed in the order their events
+        arrived for each default target, so a slow handler can't reorder a
+        channel's output.
+        """
+        target = response._defaulttarget
+        if not deferreds and target not in self.pending:
+            self.flush(response)
+            return
+        slot = [response, not deferreds]
+        self.pending.setdefault(target, deque()).append(slot)
+        if not deferreds:
+            return
+        for d in deferreds:
+            d.addErrback(lambda failure: self.error(response, failure))
+        def ready(results):
+            slot[1] = True
+            self.drain(target)
+        defer.DeferredList(deferreds).addCallback(ready)
+
+    def drain(self, target):
+        """Flushes the finished Responses at the front of a target's queue."""
+        queue = self.pending[target]
+        while queue and queue[0][1]:
+            self.flush(queue.popleft()[0])
+        if not queue:
+            del self.pending[target]
+
+    def flush(self, response):
+        """Sends everything queued on a Response."""
+        if not response._queued:
+            return
+        queued = vars(response)
         try:
-            # Check each plugin for an appropriate signal handler
-            for plugin in self.plugins + self.builtin_plugins:
-                if hasattr(plugin, signaltype):
-                    # Ensure the attribute we're looking at is a method
-                    if hasattr(getattr(plugin, signaltype), '__call__'):
-                        method = getattr(plugin, signaltype)
-                        # If this is a builtin plugin, pass it Cassium
-                        if plugin in self.builtin_plugins:
-                            method(query, self)
-                        else:
-                            method(query, response)
-            # Print log messages
-            for message in response._log:
-                self.log.info(message)
-            # Process dict-based responses
-            for channel_and_name, reason in response._kick.iteritems():
-                self.kick(*channel_and_name + (reason,))
-            for channel, topic in response._topic.iteritems():
-                self.topic(channel, topic)
-            # Nick change
-            if response._nick:
-                self.setNick(response._nick)
-            # Process list- and set-based responses
-            for responsetype in ('join', 'leave', 'mode', 'notice', 'me', 'msg'):
-                # e.g. for action in response._msg:
-                for action in getattr(response, '_' + responsetype):
-                    # Unicode fix
-                    # XXX: might be necessary for other response types?
-                    if responsetype == 'msg':
-                        action = (action[0], action[1].encode('UTF-8'))
-                    # e.g. self.msg(*action)
-                    getattr(self, responsetype)(*action)
+            for name, action in self.actions:
+                value = queued.get(name)
+                if value:
+                    action(value)
         except Exception:
-            self.msg(response._defaulttarget,
-                traceback.format_exc().splitlines()[-1])
-            traceback.print_exc()
-            pprint.pprint(vars(response), stream=sys.stderr)
+            self.error(response)
+
+    def apply_each(self, method, actions):
+        """Calls a method with each of a list of argument tuples."""
+        for action in actions:
+            method(*action)
+
+    def apply_log(self, messages):
+        for message in messages:
+            self.log.info(message)
+
+    def apply_kicks(self, kicks):
+        for (channel, name), reason in kicks.iteritems():
+            self.kick(channel, name, reason)
+
+    def apply_topics(self, topics):
+        for channel, topic in topics.iteritems():
+            self.topic(channel, topic)
+
+    def who(self, channel, text=None):
+        """Asks the server who is in a channel."""
+        self.sendLine('WHO ' + channel)
+
+    def deliver(self, kind, target, text):
+        """Sends a line from the send queue to the server."""
+        if kind == 'me':
+            # IRCClient calls actions describe()
+            kind = 'describe'
+        # e.g. self.msg(target, text)
+        getattr(self, kind)(target, text)
+
+    def error(self, response, failure=None):
+        """
+        Reports an exception raised while handling a signal.
 
-    def save(self):
-        """Calls each plugin's save() method."""
-        for plugin in self.plugins:
-            plugin.save()
+        If no Failure is given, the exception currently being handled is
+        reported.
+        """
+        if failure is None:
+            failure = Failure()
+        if response._defaulttarget:
+            self.msg(response._defaulttarget, '%s: %s' %
+                (failure.type.__name__, failure.getErrorMessage()))
+        failure.printTraceback(file=sys.stderr)
+        pprint.pprint(vars(response), stream=sys.stderr)
 
 class Control(Plugin):
     """Internal plugin used to provide admins with basic control."""
 
-    controls = ('join', 'leave', 'nick', 'import', 'reconnect', 'restart', 'save')
+    controls = ('join', 'leave', 'nick', 'import', 'rescan', 'reconnect',
+        'restart', 'save', 'stats')
+    prefixes = tuple('`' + ctl for ctl in controls)
 
     def msg(self, query, cassium):
         if not any(query.message.startswith('`' + ctl) for ctl in self.controls):
@@ -268,36 +474,112 @@ class Control(Plugin):
         elif command == 'nick':
             cassium.setNick(query.words[1])
         elif command == 'import':
-            cassium.load_plugins_from_path('plugins.' + query.words[1])
+            if cassium.manager.load_plugins_from_path(
+                    'plugins.' + query.words[1]):
+                cassium.msg(query.channel or query.user,
+                    'Loaded ' + query.words[1] + '.')
+            else:
+                cassium.msg(query.channel or query.user,
+                    query.words[1] + ' hasn\'t changed.')
+        elif command == 'rescan':
+            loaded = cassium.manager.rescan()
             cassium.msg(query.channel or query.user,
-                'Loaded ' + query.words[1] + '.')
+                'Loaded ' + ', '.join(loaded) + '.' if loaded else
+                'Nothing has changed.')
         elif command == 'save':
-            cassium.save()
+            cassium.manager.save()
         elif command == 'reconnect':
             cassium.log.critical('reconnecting')
-            cassium.save()
+            cassium.manager.save()
             cassium.quit()
         elif command == 'restart':
             cassium.log.critical('restarting')
-            cassium.save()
+            cassium.manager.save()
             reactor.stop()
+            # exec skips atexit, so make sure the chat logs are on disk
+            close_chatlogs()
             os.execv(sys.argv[0], sys.argv)
+        elif command == 'stats':
+            self.stats(query, cassium)
+
+    def stats(self, query, cassium):
+        """Reports send queue, ingress, cache and handler statistics."""
+        target = query.channel or query.user
+        action = query.words[1] if len(query.words) > 1 else None
+        profiler = cassium.manager.profiler
+        if action in ('dump', 'reset') and profiler is None:
+            return cassium.msg(target, 'Profiling is disabled.')
+        if action == 'dump':
+            path = getattr(cassium.config, 'stats_file',
+                os.path.join('save', 'stats.txt'))
+            profiler.dump(path)
+            return cassium.msg(target, 'Wrote stats to ' + path + '.')
+        if action == 'reset':
+            profiler.reset()
+            return cassium.msg(target, 'Reset stats.')
+        lines = ['Send queue: %(depth)d queued for %(targets)d targets, '
+            '%(sent)d sent, %(merged)d merged, %(dropped)d dropped' %
+            cassium.outbound.stats(),
+            'Ingress: %(admitted)d admitted, %(dropped)d dropped, %(shed)d '
+            'shed, %(batched)d batched, ignoring %(ignoring)d' %
+            cassium.ingress.stats()]
+        busiest = sorted((cache.stats() for cache in caches.values()),
+            key=lambda stats: stats['hits'] + stats['misses'], reverse=True)
+        lines.extend('Cache %(name)s: %(size)d/%(limit)d items, %(hits)d '
+            'hits, %(misses)d misses (%(ratio).0f%% hits), %(evicted)d '
+            'evicted, %(expired)d expired' % stats for stats in busiest[:5])
+        if profiler is None:
+            lines.append('Profiling is disabled.')
+        else:
+            lines.extend(stats.summary() for stats in profiler.top(5))
+        for line in lines:
+            cassium.outbound.put('msg', target, line)
+
+class NetworkConfig(object):
+    """
+    The configuration of one network when Cassium is on several.
+
+    The network's own settings override those of the configuration module,
+    and anything it doesn't set falls through to the module.
+    """
+
+    def __init__(self, config, network, settings):
+        self.config = config
+        self.network = network
+        self.__dict__.update(settings)
+
+    def __getattr__(self, name):
+        return getattr(self.config, name)
 
 class CassiumFactory(protocol.ClientFactory):
     """A Twisted factory that instantiates or reinstantiates Cassium."""
 
-    def __init__(self, config):
+    def __init__(self, config, manager=None):
+        """
+        Initialize the factory with a configuration module.
+
+        Every connection the factory makes shares the given PluginManager,
+        which is created if not given.
+        """
         self.config = config
-        # Set up logging
+        # Set up logging, unless another factory has already
         logger = logging.getLogger()
-        logger.setLevel(getattr(logging, config.log_verbosity))
-        handler = logging.StreamHandler()
-        handler.setFormatter(logging.Formatter(fmt=config.log_format))
-        logger.addHandler(handler)
-
+        if not logger.handlers:
+            logger.setLevel(getattr(logging, config.log_verbosity))
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(fmt=config.log_format))
+            logger.addHandler(handler)
+        # Bound the number of blocking handlers that can run at once
+        if hasattr(config, 'thread_pool_size'):
+            reactor.suggestThreadPoolSize(config.thread_pool_size)
+        if manager is None:
+            manager = PluginManager(config, [Control()])
+        self.manager = manager
+        if getattr(config, 'watch_plugins', False):
+            manager.watch(getattr(config, 'watch_interval', 2.))
 
     def buildProtocol(self, addr):
-        cassium = Cassium(self.config)
+        cassium = Cassium(self.config, self.manager)
         cassium.factory = self
         return cassium
 
@@ -305,4 +587,11 @@ class CassiumFactory(protocol.ClientFactory):
         connector.connect()
 
     def clientConnectionFailed(self, connector, reason):
-        reactor.stop()
+        # With several networks, one failing shouldn't stop the others
+        delay = getattr(self.config, 'retry_delay', None)
+        if delay is None and getattr(self.config, 'networks', None):
+            delay = 60.
+        if delay:
+            reactor.callLater(delay, connector.connect)
+        else:
+            reactor.stop()
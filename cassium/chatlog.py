@@ -0,0 +1,216 @@
+"""
+Buffered, structured logs of channel traffic.
+
+Each line of a log is a record of tab-separated fields:
+
+    time, type, channel, user, args...
+
+where time is seconds since the epoch, and args depend on the type: the text
+of a msg, action, leave or quit, the kickee and reason of a kick, the topic
+of a topic change and the new nick of a nick change. Tabs, newlines and
+backslashes in fields are escaped with backslashes, so a line can be split
+on tabs without further parsing unless it contains a backslash.
+
+Logs are kept in one file per channel per (UTC) day, as
+directory/[network/]channel/YYYY-MM-DD.log. Compressed logs end in .log.gz
+and hold one gzip member per batch written, which gzip tools read as one
+stream.
+"""
+import atexit
+from collections import namedtuple
+import gzip
+import logging
+import os
+import re
+from threading import Condition, Thread
+import time
+
+from state import irc_lower
+
+__all__ = ['ChatLog', 'Record', 'get_chatlog', 'read']
+
+Record = namedtuple('Record', 'time type channel user args')
+
+ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+UNESCAPES = dict((escaped, char) for char, escaped in ESCAPES.items())
+ESCAPED = re.compile(r'[\\\t\n\r]')
+UNESCAPED = re.compile(r'\\[\\tnr]')
+
+def escape(field):
+    if field is None:
+        return ''
+    if isinstance(field, unicode):
+        field = field.encode('UTF-8')
+    return ESCAPED.sub(lambda match: ESCAPES[match.group()], field)
+
+def unescape(field):
+    if '\\' not in field:
+        return field
+    return UNESCAPED.sub(lambda match: UNESCAPES[match.group()], field)
+
+
+class ChatLog(object):
+    """
+    Writes chat records from a background thread.
+
+    Records are buffered in memory and written in batches every `interval`
+    seconds, or as soon as `batch` records are waiting, so logging costs the
+    reactor thread no I/O. Up to `limit` records are buffered; beyond that
+    records are dropped rather than letting a stalled disk use up memory.
+    """
+
+    def __init__(self, directory, compress=False, interval=1., batch=1000,
+            limit=100000):
+        self.directory = directory
+        self.compress = compress
+        self.interval = interval
+        self.batch = batch
+        self.limit = limit
+        self.log = logging.getLogger(__name__)
+        self.buffer = []
+        self.condition = Condition()
+        self.thread = None
+        self.closed = False
+        # Whether to write the buffer without waiting out the interval
+        self.urgent = False
+        # Counters
+        self.queued = 0
+        self.finished = 0   # Records either written or dropped
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, network, channel, type, user, *args):
+        """Buffers a record, stamped with the current time."""
+        now = time.time()
+        line = '\t'.join(['%.3f' % now, type, escape(channel),
+            escape(user)] + [escape(arg) for arg in args]) + '\n'
+        with self.condition:
+            if len(self.buffer) >= self.limit:
+                self.dropped += 1
+                return
+            self.buffer.append((network, channel, now, line))
+            self.queued += 1
+            if self.thread is None:
+                self.start()
+            if len(self.buffer) >= self.batch:
+                self.urgent = True
+                self.condition.notify()
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='chatlog')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.urgent and not self.closed:
+                    self.condition.wait(self.interval)
+                self.urgent = False
+                buffer, self.buffer = self.buffer, []
+                closed = self.closed
+            if buffer:
+                self.flush_buffer(buffer)
+                with self.condition:
+                    self.finished += len(buffer)
+                    # Wake up flush()
+                    self.condition.notify_all()
+            if closed:
+                return
+
+    def flush_buffer(self, buffer):
+        """Writes a batch of records, grouped by file."""
+        files = {}
+        written = dropped = 0
+        for network, channel, stamp, line in buffer:
+            path = self.path(network, channel, stamp)
+            files.setdefault(path, []).append(line)
+        for path, lines in files.items():
+            try:
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if self.compress:
+                    f = gzip.open(path, 'ab')
+                else:
+                    f = open(path, 'ab')
+                try:
+                    f.write(''.join(lines))
+                finally:
+                    f.close()
+                written += len(lines)
+            except (IOError, OSError):
+                self.log.exception('failed to write ' + path)
+                dropped += len(lines)
+        # The counters are shared with write() and stats readers
+        with self.condition:
+            self.written += written
+            self.dropped += dropped
+
+    def path(self, network, channel, stamp):
+        """Gets the file a channel's records from a given time go in."""
+        parts = [self.directory]
+        if network:
+            parts.append(network)
+        parts.append(irc_lower(channel or '-').replace(os.path.sep, '_'))
+        name = time.strftime('%Y-%m-%d', time.gmtime(stamp)) + '.log'
+        if self.compress:
+            name += '.gz'
+        parts.append(name)
+        return os.path.join(*parts)
+
+    def flush(self):
+        """Waits until everything buffered so far has been written."""
+        with self.condition:
+            if self.thread is None:
+                return
+            queued = self.queued
+            self.urgent = True
+            self.condition.notify_all()
+            while self.finished < queued and self.thread.is_alive():
+                self.condition.wait(self.interval)
+
+    def close(self):
+        """Writes everything buffered and stops the background thread."""
+        with self.condition:
+            if self.thread is None or self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+# Shared chat logs by directory, so reloaded plugins keep using theirs
+chatlogs = {}
+
+def get_chatlog(directory, compress=False):
+    """Gets the ChatLog writing to a directory, creating it if need be."""
+    chatlog = chatlogs.get(directory)
+    if chatlog is None:
+        chatlog = chatlogs[directory] = ChatLog(directory, compress)
+    return chatlog
+
+def close_chatlogs():
+    """Writes everything buffered by every chat log and stops them."""
+    for chatlog in list(chatlogs.values()):
+        chatlog.close()
+
+
+def read(path):
+    """Yields the Records in a log file, which may be compressed."""
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    try:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            if '\\' in line:
+                fields = [unescape(field) for field in fields]
+            yield Record(float(fields[0]), fields[1], fields[2], fields[3],
+                fields[4:])
+    finally:
+        f.close()
@@ -0,0 +1,172 @@
+from collections import namedtuple
+import logging
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+from state import irc_lower
+
+__all__ = ['History', 'Line']
+
+Line = namedtuple('Line', 'time network channel nick type text')
+
+# The columns selected for a Line
+COLUMNS = 'time, network, channel, nick, type, text'
+
+def decode(value):
+    """Decodes IRC text for sqlite, which only takes ASCII bytestrings."""
+    if isinstance(value, str):
+        return value.decode('UTF-8', 'replace')
+    return value
+
+class History(object):
+    """
+    An on-disk, full-text index of what was said in Cassium's channels.
+
+    Lines are kept in an sqlite database, indexed with FTS4 (or FTS3 where
+    that's all sqlite has). New lines are buffered and inserted in a batch
+    every `interval` seconds; at most `limit` lines are buffered. All
+    database work happens on a dedicated thread, so lookups return Deferreds
+    and never block the reactor. Channels and nicks are matched in any case.
+    """
+
+    def __init__(self, path, interval=1., limit=100000):
+        self.log = logging.getLogger(__name__)
+        self.limit = limit
+        # Whether full-text search is available, which setup() determines
+        # once connected
+        self.fts = None
+        # One thread, so statements run in the order they were issued
+        self.pool = adbapi.ConnectionPool('sqlite3', path,
+            check_same_thread=False, cp_min=1, cp_max=1,
+            cp_openfun=self.setup)
+        self.rows = []
+        self.dropped = 0
+        self.timer = LoopingCall(self.flush)
+        self.timer.start(interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def setup(self, db):
+        """Creates the tables in a new connection's database."""
+        db.execute('CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, '
+            'time REAL, network TEXT, channel TEXT, nick TEXT, '
+            'nick_key TEXT, type TEXT, text TEXT)')
+        db.execute('CREATE INDEX IF NOT EXISTS lines_channel '
+            'ON lines (channel, id)')
+        db.execute('CREATE INDEX IF NOT EXISTS lines_nick '
+            'ON lines (nick_key, id)')
+        for module in ('fts4', 'fts3'):
+            try:
+                db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS words '
+                    'USING %s (text)' % module)
+            except db.OperationalError:
+                continue
+            self.fts = True
+            break
+        else:
+            self.fts = False
+            self.log.warn('sqlite has no full-text search; searching '
+                'history will scan every line')
+        try:
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+        except db.DatabaseError:
+            pass
+        db.commit()
+
+    def add(self, time, network, channel, nick, type, line):
+        """Buffers a line to be indexed."""
+        if len(self.rows) >= self.limit:
+            self.dropped += 1
+            return
+        self.rows.append((time, network, decode(irc_lower(channel)),
+            decode(nick), decode(irc_lower(nick)), type, decode(line)))
+
+    def flush(self):
+        """Inserts the buffered lines, returning a Deferred."""
+        if not self.rows:
+            return defer.succeed(None)
+        rows, self.rows = self.rows, []
+        d = self.pool.runInteraction(self.insert, rows)
+        d.addErrback(lambda failure: self.log.error(
+            'failed to index %d lines: %s' %
+                (len(rows), failure.getErrorMessage())))
+        return d
+
+    def insert(self, cursor, rows):
+        """Inserts lines and indexes their words. Runs in a thread."""
+        cursor.execute('SELECT max(id) FROM lines')
+        last = cursor.fetchone()[0] or 0
+        cursor.executemany('INSERT INTO lines (time, network, channel, nick, '
+            'nick_key, type, text) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        if self.fts:
+            cursor.execute('INSERT INTO words (docid, text) '
+                'SELECT id, text FROM lines WHERE id > ?', (last,))
+
+    def query(self, where, args, limit):
+        # Anything buffered is inserted first, as statements run in order
+        self.flush()
+        d = self.pool.runQuery('SELECT %s FROM lines WHERE %s '
+            'ORDER BY id DESC LIMIT ?' % (COLUMNS, ' AND '.join(where)),
+            tuple(args) + (limit,))
+        d.addCallback(lambda rows: [Line(*row) for row in rows])
+        return d
+
+    def filters(self, channel, nick, network, skip=()):
+        where, args = [], []
+        if isinstance(channel, basestring):
+            where.append('channel = ?')
+            args.append(decode(irc_lower(channel)))
+        elif channel is not None:
+            # Any of several channels; an empty list matches nothing
+            where.append('channel IN (%s)' % ', '.join('?' * len(channel)))
+            args.extend(decode(irc_lower(name)) for name in channel)
+        if nick is not None:
+            where.append('nick_key = ?')
+            args.append(decode(irc_lower(nick)))
+        if network is not None:
+            where.append('network = ?')
+            args.append(network)
+        for word in skip:
+            word = decode(word) + u' '
+            where.append("substr(text || ' ', 1, ?) != ?")
+            args.extend((len(word), word))
+        return where, args
+
+    def search(self, terms, channel=None, nick=None, network=None, limit=10,
+            skip=()):
+        """
+        Finds the most recent lines matching full-text search terms, as a
+        Deferred list of Lines, newest first.
+
+        Terms use sqlite's full-text query syntax, e.g. 'foo bar' for lines
+        with both words, 'foo OR bar', '"foo bar"' or 'foo*'; malformed terms
+        fail with sqlite3.OperationalError. `channel` may be a channel or a
+        list of channels, and lines whose first word is in `skip`, such as
+        commands, are left out.
+        """
+        where, args = self.filters(channel, nick, network, skip)
+        if self.fts is not False:
+            where.insert(0, 'id IN (SELECT docid FROM words '
+                'WHERE words MATCH ?)')
+            args.insert(0, decode(terms))
+        else:
+            for term in decode(terms).split():
+                where.append('text LIKE ?')
+                args.append('%' + term.strip('"*') + '%')
+        return self.query(where or ['1'], args, limit)
+
+    def last(self, nick, channel=None, network=None, limit=1, skip=()):
+        """
+        Finds what a nick said most recently, as a Deferred list, leaving
+        out lines whose first word is in `skip`.
+        """
+        where, args = self.filters(channel, nick, network, skip)
+        return self.query(where, args, limit)
+
+    def close(self):
+        """Inserts the buffered lines and stops indexing."""
+        if self.timer.running:
+            self.timer.stop()
+        return self.flush()
@@ -0,0 +1,152 @@
+import logging
+
+from twisted.internet import reactor
+
+from cache import LRUCache
+from outbound import TokenBucket
+from state import irc_lower
+
+__all__ = ['Ingress']
+
+class Ingress(object):
+    """
+    Decides which incoming events are signalled to plugins, so a flood costs
+    bounded CPU and memory.
+
+    Messages and actions are limited to `source_rate` per second (in bursts
+    of `source_burst`) from each host and to `channel_rate` per second (in
+    bursts of `channel_burst`) in each channel. A host that goes over its
+    limit is ignored for `ignore_time` seconds. Buckets and ignores are kept
+    for at most `limit` hosts and channels each, evicting the least recently
+    seen. Messages are also dropped while more than `backlog` lines wait in
+    the send queue, as reported by the `depth` callable, so replies can't
+    pile up faster than they're sent. Any rate of None disables that limit.
+
+    Joins and quits beyond `mass_rate` per second (in bursts of `mass_burst`)
+    are gathered for `mass_window` seconds instead, and handed to
+    `emit(signaltype, channel, users, message)` as one massjoin or massquit
+    per channel (and quit message). At most `limit` users are gathered.
+    """
+
+    def __init__(self, emit, depth, source_rate=2., source_burst=10,
+            channel_rate=20., channel_burst=50, ignore_time=60.,
+            limit=10000, backlog=500, mass_rate=5., mass_burst=20,
+            mass_window=1., clock=reactor):
+        self.emit = emit
+        self.depth = depth
+        self.clock = clock
+        self.log = logging.getLogger(__name__)
+        self.source_rate = source_rate
+        self.source_burst = source_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.ignore_time = ignore_time
+        self.limit = limit
+        self.backlog = backlog
+        self.mass_window = mass_window
+        self.sources = LRUCache(limit)      # Host -> TokenBucket
+        self.channels = LRUCache(limit)     # Channel -> TokenBucket
+        self.ignored = LRUCache(limit)      # Host -> time ignored until
+        self.mass = None
+        if mass_rate is not None:
+            self.mass = TokenBucket(mass_rate, mass_burst, clock.seconds)
+        # (signal type, channel, message) -> users, gathered for the window
+        self.batches = {}
+        self.gathered = 0
+        self.call = None
+        # Counters
+        self.admitted = 0
+        self.dropped = 0
+        self.shed = 0
+        self.batched = 0
+
+    def bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst,
+                self.clock.seconds)
+        return bucket
+
+    def admit(self, user, channel):
+        """Returns whether to signal a message or action."""
+        if self.backlog is not None and self.depth() > self.backlog:
+            self.shed += 1
+            return False
+        source = irc_lower(user.split('@', 1)[-1])
+        now = self.clock.seconds()
+        until = self.ignored.get(source)
+        if until is not None:
+            if now < until:
+                self.dropped += 1
+                return False
+            del self.ignored[source]
+        bucket = None
+        if self.source_rate is not None:
+            bucket = self.bucket(self.sources, source, self.source_rate,
+                self.source_burst)
+            if not bucket.ready():
+                self.log.warn('ignoring %s for %.0fs: flooding' %
+                    (user, self.ignore_time))
+                self.ignored[source] = now + self.ignore_time
+                self.sources.pop(source)
+                self.dropped += 1
+                return False
+        if self.channel_rate is not None and channel[:1] in '#&':
+            channel_bucket = self.bucket(self.channels, irc_lower(channel),
+                self.channel_rate, self.channel_burst)
+            if not channel_bucket.ready():
+                self.dropped += 1
+                return False
+            channel_bucket.take()
+        if bucket is not None:
+            bucket.take()
+        self.admitted += 1
+        return True
+
+    def gather(self, signaltype, channels, user, message=None):
+        """
+        Gathers a join or quit into a batch if they're arriving too fast to
+        signal one by one. Returns whether it was gathered.
+        """
+        if self.mass is None:
+            return False
+        if not self.batches and self.mass.ready():
+            self.mass.take()
+            return False
+        if self.gathered >= self.limit:
+            self.dropped += 1
+            return True
+        for channel in channels:
+            self.batches.setdefault((signaltype, channel, message),
+                []).append(user)
+        self.gathered += 1
+        self.batched += 1
+        if self.call is None:
+            self.call = self.clock.callLater(self.mass_window, self.flush)
+        return True
+
+    def flush(self):
+        """Hands each gathered batch to emit()."""
+        self.call = None
+        batches, self.batches = self.batches, {}
+        self.gathered = 0
+        for (signaltype, channel, message), users in sorted(batches.items()):
+            self.emit('mass' + signaltype, channel, users, message)
+
+    def stop(self):
+        """Discards the gathered batches."""
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.batches.clear()
+        self.gathered = 0
+
+    def stats(self):
+        """Returns a dict of counters."""
+        return {
+            'admitted': self.admitted,
+            'dropped': self.dropped,
+            'shed': self.shed,
+            'batched': self.batched,
+            'ignoring': len(self.ignored),
+        }
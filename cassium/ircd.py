@@ -0,0 +1,335 @@
+"""
+A minimal IRC server, for testing Cassium without a network.
+
+It handles registration (NICK and USER), JOIN, PART, PRIVMSG, NOTICE, KICK,
+TOPIC, NICK, QUIT, PING, NAMES and WHO, replying with the numerics IRCClient
+and Cassium rely on. There are no modes, operators, bans or flood limits:
+anyone may kick anyone or set any topic, and everything is kept in memory.
+
+    from cassium.ircd import IRCServer
+    reactor.listenTCP(6667, IRCServer(), interface='127.0.0.1')
+"""
+import logging
+
+from twisted.internet import protocol
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.words.protocols.irc import parsemsg
+
+from state import irc_lower
+
+__all__ = ['IRCServer', 'IRCUser']
+
+# The most names sent in one RPL_NAMREPLY
+NAMES_PER_REPLY = 50
+
+class Channel(object):
+    """A channel and its members."""
+
+    def __init__(self, name):
+        self.name = name
+        self.topic = None
+        self.members = {}   # Lowercased nick -> IRCUser
+
+
+class IRCUser(LineOnlyReceiver):
+    """A client's connection to the server."""
+
+    delimiter = '\r\n'
+    MAX_LENGTH = 512
+
+    # Commands allowed before registering
+    UNREGISTERED = ('NICK', 'USER', 'PING', 'PONG', 'QUIT', 'CAP', 'PASS')
+
+    def __init__(self):
+        self.nick = None
+        self.user = None
+        self.realname = None
+        self.host = None
+        self.registered = False
+        self.channels = {}  # Lowercased name -> Channel
+
+    @property
+    def prefix(self):
+        return '%s!%s@%s' % (self.nick, self.user, self.host)
+
+    def connectionMade(self):
+        # Each connection gets a host of its own, as if it came from a
+        # different machine
+        self.factory.connections += 1
+        self.host = 'client%d.%s' % (self.factory.connections,
+            self.factory.name)
+
+    def connectionLost(self, reason):
+        self.quit('Connection closed')
+
+    def lineReceived(self, line):
+        self.factory.received += 1
+        try:
+            prefix, command, params = parsemsg(line)
+        except Exception:
+            return
+        command = command.upper()
+        if not self.registered and command not in self.UNREGISTERED:
+            return self.reply('451', command, 'You have not registered')
+        method = getattr(self, 'irc_' + command, None)
+        if method is None:
+            return self.reply('421', command, 'Unknown command')
+        try:
+            method(params)
+        except IndexError:
+            self.reply('461', command, 'Not enough parameters')
+
+    def send(self, prefix, command, *params):
+        """Sends a message, the last parameter of which may hold spaces."""
+        self.sendLine(line(prefix, command, params))
+        self.factory.sent += 1
+
+    def reply(self, numeric, *params):
+        """Sends a numeric reply from the server."""
+        self.send(self.factory.name, numeric, self.nick or '*', *params)
+
+    def peers(self):
+        """Gets everyone who shares a channel with this user, and them."""
+        peers = {irc_lower(self.nick): self}
+        for channel in self.channels.values():
+            peers.update(channel.members)
+        return peers.values()
+
+    def channel(self, name):
+        """Gets a channel this user is in, replying with an error if not."""
+        channel = self.channels.get(irc_lower(name))
+        if channel is None:
+            self.reply('442', name, 'You\'re not on that channel')
+        return channel
+
+    def register(self):
+        if self.registered or self.nick is None or self.user is None:
+            return
+        if irc_lower(self.nick) in self.factory.users:
+            self.reply('433', self.nick, 'Nickname is already in use')
+            self.nick = None
+            return
+        self.registered = True
+        self.factory.users[irc_lower(self.nick)] = self
+        self.reply('001', 'Welcome to the Internet Relay Network ' +
+            self.prefix)
+        self.reply('002', 'Your host is %s' % self.factory.name)
+        self.reply('003', 'This server was created for testing')
+        self.reply('004', self.factory.name, 'cassium-ircd', 'o', 'o')
+        self.reply('422', 'MOTD File is missing')
+
+    def quit(self, message):
+        """Removes the user from the server, telling their peers."""
+        if not self.registered:
+            return
+        self.registered = False
+        self.factory.broadcast([peer for peer in self.peers()
+            if peer is not self], line(self.prefix, 'QUIT', (message,)))
+        for key, channel in self.channels.items():
+            self.factory.part(channel, self)
+        self.channels.clear()
+        self.factory.users.pop(irc_lower(self.nick), None)
+
+    def irc_NICK(self, params):
+        nick = params[0]
+        key = irc_lower(nick)
+        if self.factory.users.get(key, self) is not self:
+            return self.reply('433', nick, 'Nickname is already in use')
+        if not self.registered:
+            self.nick = nick
+            return self.register()
+        self.factory.broadcast(self.peers(),
+            line(self.prefix, 'NICK', (nick,)))
+        old = irc_lower(self.nick)
+        del self.factory.users[old]
+        self.factory.users[key] = self
+        for channel in self.channels.values():
+            del channel.members[old]
+            channel.members[key] = self
+        self.nick = nick
+
+    def irc_USER(self, params):
+        if self.registered:
+            return self.reply('462', 'You may not reregister')
+        self.user = params[0]
+        self.realname = params[3]
+        self.register()
+
+    def irc_PING(self, params):
+        self.send(self.factory.name, 'PONG', self.factory.name, params[0])
+
+    def irc_PONG(self, params):
+        pass
+
+    def irc_CAP(self, params):
+        pass
+
+    def irc_PASS(self, params):
+        pass
+
+    def irc_QUIT(self, params):
+        self.quit(params[0] if params else 'Quit')
+        self.transport.loseConnection()
+
+    def irc_JOIN(self, params):
+        for name in params[0].split(','):
+            if name[:1] not in '#&':
+                self.reply('403', name, 'No such channel')
+                continue
+            key = irc_lower(name)
+            if key in self.channels:
+                continue
+            channel = self.factory.channels.get(key)
+            if channel is None:
+                channel = self.factory.channels[key] = Channel(name)
+            channel.members[irc_lower(self.nick)] = self
+            self.channels[key] = channel
+            self.factory.broadcast(channel.members.values(),
+                line(self.prefix, 'JOIN', (channel.name,)))
+            if channel.topic is not None:
+                self.reply('332', channel.name, channel.topic)
+            self.names(channel)
+
+    def irc_PART(self, params):
+        message = params[1] if len(params) > 1 else self.nick
+        for name in params[0].split(','):
+            channel = self.channel(name)
+            if channel is not None:
+                self.factory.broadcast(channel.members.values(),
+                    line(self.prefix, 'PART', (channel.name, message)))
+                del self.channels[irc_lower(name)]
+                self.factory.part(channel, self)
+
+    def irc_PRIVMSG(self, params, command='PRIVMSG'):
+        target, text = params[0], params[1]
+        key = irc_lower(target)
+        if target[:1] in '#&':
+            channel = self.channels.get(key)
+            if channel is None:
+                return self.reply('404', target, 'Cannot send to channel')
+            self.factory.relayed += 1
+            self.factory.broadcast([member for member in
+                channel.members.values() if member is not self],
+                line(self.prefix, command, (channel.name, text)))
+        else:
+            user = self.factory.users.get(key)
+            if user is None:
+                return self.reply('401', target, 'No such nick/channel')
+            self.factory.relayed += 1
+            user.send(self.prefix, command, user.nick, text)
+
+    def irc_NOTICE(self, params):
+        self.irc_PRIVMSG(params, 'NOTICE')
+
+    def irc_KICK(self, params):
+        channel = self.channel(params[0])
+        if channel is None:
+            return
+        key = irc_lower(params[1])
+        kickee = channel.members.get(key)
+        if kickee is None:
+            return self.reply('441', params[1], channel.name,
+                'They aren\'t on that channel')
+        message = params[2] if len(params) > 2 else self.nick
+        self.factory.broadcast(channel.members.values(),
+            line(self.prefix, 'KICK', (channel.name, kickee.nick, message)))
+        del kickee.channels[irc_lower(channel.name)]
+        self.factory.part(channel, kickee)
+
+    def irc_TOPIC(self, params):
+        channel = self.channel(params[0])
+        if channel is None:
+            return
+        if len(params) == 1:
+            if channel.topic is None:
+                self.reply('331', channel.name, 'No topic is set')
+            else:
+                self.reply('332', channel.name, channel.topic)
+            return
+        channel.topic = params[1]
+        self.factory.broadcast(channel.members.values(),
+            line(self.prefix, 'TOPIC', (channel.name, params[1])))
+
+    def irc_NAMES(self, params):
+        for name in params[0].split(','):
+            channel = self.factory.channels.get(irc_lower(name))
+            if channel is not None:
+                self.names(channel)
+            else:
+                self.reply('366', name, 'End of NAMES list')
+
+    def names(self, channel):
+        nicks = sorted(member.nick for member in channel.members.values())
+        for i in range(0, len(nicks), NAMES_PER_REPLY):
+            self.reply('353', '=', channel.name,
+                ' '.join(nicks[i:i + NAMES_PER_REPLY]))
+        self.reply('366', channel.name, 'End of NAMES list')
+
+    def irc_WHO(self, params):
+        mask = params[0] if params else '*'
+        channel = self.factory.channels.get(irc_lower(mask))
+        if channel is not None:
+            for member in channel.members.values():
+                self.reply('352', channel.name, member.user, member.host,
+                    self.factory.name, member.nick, 'H',
+                    '0 ' + member.realname)
+        self.reply('315', mask, 'End of WHO list')
+
+    def irc_MODE(self, params):
+        # Modes aren't supported, but clients ask for them on joining
+        if params[0][:1] in '#&' and len(params) == 1:
+            self.reply('324', params[0], '+')
+
+
+def line(prefix, command, params):
+    """Formats an IRC line, with the last parameter as the trailing one."""
+    params = list(params)
+    if params:
+        params[-1] = ':' + params[-1]
+    if prefix:
+        return ' '.join([':' + prefix, command] + params)
+    return ' '.join([command] + params)
+
+
+class IRCServer(protocol.ServerFactory):
+    """
+    A minimal IRC server (see IRCUser), keeping track of who is on it and
+    in which channels. `received`, `sent` and `relayed` count the lines
+    received from and sent to clients, and the messages relayed between
+    them.
+    """
+
+    protocol = IRCUser
+
+    def __init__(self, name='irc.cassium.test'):
+        self.name = name
+        self.log = logging.getLogger(__name__)
+        self.users = {}     # Lowercased nick -> IRCUser
+        self.channels = {}  # Lowercased name -> Channel
+        # Counters
+        self.connections = 0
+        self.received = 0
+        self.relayed = 0
+        self.sent = 0
+
+    def broadcast(self, users, text):
+        """Sends a line to each of the given users."""
+        for user in users:
+            user.sendLine(text)
+            self.sent += 1
+
+    def part(self, channel, user):
+        """Removes a user from a channel, forgetting the channel if empty."""
+        channel.members.pop(irc_lower(user.nick), None)
+        if not channel.members:
+            self.channels.pop(irc_lower(channel.name), None)
+
+    def stats(self):
+        """Returns a dict of the server's size and counters."""
+        return {
+            'users': len(self.users),
+            'channels': len(self.channels),
+            'received': self.received,
+            'relayed': self.relayed,
+            'sent': self.sent,
+        }
@@ -0,0 +1,112 @@
+import logging
+import os
+import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from persist import atomic_write
+from plugin import *
+from plugin import run_blocking
+
+__all__ = ['StandIn', 'LazyPlugin', 'load_manifest', 'save_manifest']
+
+log = logging.getLogger(__name__)
+
+def load_manifest(path):
+    """
+    Reads a cached manifest of plugin modules, as a dict mapping each
+    module's dotted path to the modification time of its source, the
+    descriptions of its plugins (see manager.describe()) and the time their
+    next job is due, or None.
+    """
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        log.exception('ignoring unreadable plugin manifest ' + path)
+        return {}
+
+def save_manifest(path, manifest):
+    """Writes a manifest of plugin modules."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    atomic_write(path, pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL))
+
+class StandIn(Plugin):
+    """
+    Stands in for a plugin that isn't loaded in this process.
+
+    A stand-in is made from a description of the plugin (see
+    manager.describe()): it declares the same triggers, and has an instance
+    of its `handler` class for each signal the plugin handles.
+    """
+
+    storage = None
+    handler = None
+
+    def __init__(self, name, handlers, commands, prefixes, patterns):
+        self.name = name
+        self.commands = tuple(commands)
+        self.prefixes = tuple(prefixes)
+        self.patterns = tuple(source if flags is None else
+            re.compile(source, flags) for source, flags in patterns)
+        for signaltype, blocking, timeout in handlers:
+            setattr(self, signaltype,
+                self.handler(self, signaltype, blocking, timeout))
+
+    def fqn(self):
+        return self.name
+
+    def __str__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+
+class LazyHandler(object):
+    """
+    A signal handler of a plugin that hasn't been loaded yet.
+
+    Calling it loads the plugin's module, and then calls the plugin's own
+    handler, running it in a thread if it's blocking.
+    """
+
+    blocking = False
+
+    def __init__(self, plugin, signaltype, blocking, timeout):
+        self.__self__ = plugin
+        self.__name__ = signaltype
+        self.timeout = timeout
+
+    def __call__(self, query, response):
+        manager = self.__self__.manager
+        manager.realize(self.__self__.module)
+        i = manager.index.get(self.__self__.name)
+        plugin = manager.plugins[i] if i is not None else None
+        # The plugin may be gone from its module, or its module may have
+        # failed to import
+        if plugin is None or plugin is self.__self__:
+            return None
+        method = getattr(plugin, self.__name__, None)
+        if not hasattr(method, '__call__'):
+            return None
+        if not getattr(method, 'blocking', False):
+            return method(query, response)
+        return run_blocking(method, query, response)
+
+
+class LazyPlugin(StandIn):
+    """
+    Stands in for a plugin whose module hasn't been imported yet, as
+    described by the manifest cached from an earlier run.
+    """
+
+    handler = LazyHandler
+
+    def __init__(self, manager, module, *description):
+        self.manager = manager
+        self.module = module
+        StandIn.__init__(self, *description)
@@ -0,0 +1,627 @@
+import glob
+from inspect import isclass
+import logging
+import os
+import sys
+import time
+
+from twisted.internet import task, threads
+
+from cache import save_caches
+from plugin import *
+from scheduler import JobCall, Scheduler
+from history import History
+from lazy import LazyPlugin, load_manifest, save_manifest
+from stats import Profiler
+from triggers import TriggerIndex
+from watcher import PluginWatcher
+
+__all__ = ['PluginManager', 'SIGNALS', 'describe']
+
+# Every signal type a plugin may handle
+SIGNALS = ('signedon', 'ijoin', 'ileft', 'ikick', 'inick', 'msg', 'join',
+    'leave', 'quit', 'kick', 'action', 'topic', 'nick', 'massjoin',
+    'massquit', 'tick')
+
+def source_mtime(module):
+    """Gets the modification time of a module's source file, if any."""
+    filename = getattr(module, '__file__', None)
+    if filename is None:
+        return None
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+def module_mtime(path):
+    """
+    Gets the modification time of a plugin module's source file, given its
+    dotted path, without importing it.
+    """
+    try:
+        return os.path.getmtime(path.replace('.', os.path.sep) + '.py')
+    except OSError:
+        return None
+
+def module_of(plugin):
+    """Gets the dotted path of the module a plugin comes from."""
+    if isinstance(plugin, LazyPlugin):
+        return plugin.module
+    return plugin.__class__.__module__
+
+def pattern_source(pattern):
+    """Gets a trigger pattern as a (source, flags) pair."""
+    if hasattr(pattern, 'search'):
+        return pattern.pattern, pattern.flags
+    return pattern, None
+
+def describe(plugin):
+    """
+    Describes a plugin as (fqn, handlers, commands, prefixes, patterns),
+    where each handler is a (signal type, blocking, timeout) tuple and each
+    pattern a (source, flags) pair. A stand-in for the plugin can be made
+    from the description alone.
+    """
+    handlers = []
+    for signaltype in SIGNALS:
+        method = getattr(plugin, signaltype, None)
+        if hasattr(method, '__call__'):
+            handlers.append((signaltype,
+                bool(getattr(method, 'blocking', False)),
+                getattr(method, 'timeout', None)))
+    return (plugin.fqn(), tuple(handlers), tuple(plugin.commands or ()),
+        tuple(plugin.prefixes or ()),
+        tuple(pattern_source(pattern) for pattern in plugin.patterns or ()))
+
+def next_job(plugins):
+    """Gets the time the earliest of some plugins' jobs is due, or None."""
+    times = [entry[0] for plugin in plugins
+        for entry in plugin.__dict__.get('_jobs', {}).values()]
+    return min(times) if times else None
+
+def find_modules(directory):
+    """
+    Returns the dotted paths of the plugin modules under a directory, in
+    alphabetical order.
+    """
+    paths = []
+    for node in sorted(glob.iglob(os.path.join(directory, '*'))):
+        # Recurse into directories
+        if os.path.isdir(node):
+            paths.extend(find_modules(node))
+        # Don't load __init__.py
+        elif (node.endswith('.py') and
+                os.path.split(node)[1] != '__init__.py'):
+            # Convert filesystem path to dot-delimited path
+            paths.append(os.path.splitext(node)[0].replace(os.path.sep, '.'))
+    return paths
+
+class PluginManager(object):
+    """
+    Loads plugins and keeps the tables used to dispatch signals to them.
+
+    A single manager can be shared by every connection in the process, so
+    plugins are loaded once and hold one copy of their data however many
+    networks Cassium is on.
+    """
+
+    def __init__(self, config, builtin_plugins=()):
+        """Loads the plugins named by a configuration module."""
+        self.started = time.time()
+        # How long each part of startup took, in seconds
+        self.startup_times = {}
+        self.config = config
+        self.log = logging.getLogger(__name__)
+        self.plugins = []
+        self.builtin_plugins = list(builtin_plugins)
+        self.handlers = {}
+        self.triggers = TriggerIndex([])
+        # Handler timing, which costs nothing unless enabled
+        self.profiler = None
+        if getattr(config, 'profile', False):
+            self.profiler = Profiler(slow=getattr(config, 'profile_slow', .5))
+        # Ticks, shared by every connection and started by the first
+        self.tick_timer = None
+        # Periodic checkpointing, driven by the ticks
+        self.autosaving = False
+        self.last_autosave = time.time()
+        # Plugins' scheduled jobs, run on the connections that are signed on
+        self.scheduler = Scheduler(self)
+        self.connections = []
+        # Source modification times of loaded modules, by dotted path
+        self.mtimes = {}
+        # Positions in self.plugins by fully qualified name
+        self.index = {}
+        self.watcher = None
+        # The full-text index of channel history
+        self.history = None
+        if getattr(config, 'history_file', None):
+            self.history = History(config.history_file)
+        # Worker processes hosting some of the plugins
+        self.workers = None
+        if getattr(config, 'workers', None):
+            # Imported here, as the worker module imports this one
+            from worker import WorkerPool
+            self.workers = WorkerPool(self, config.workers,
+                getattr(config, 'worker_restart_delay', 1.))
+        # With lazy startup, modules described by the cached manifest aren't
+        # imported until their plugins are first used, or in the background
+        # once Cassium has signed on
+        self.lazy = {}      # Dotted path -> source modification time
+        self.manifest = None
+        self.manifest_changed = False
+        self.signon_time = None
+        # Import times of the modules loaded, by dotted path
+        self.import_times = {}
+        if getattr(config, 'lazy_startup', False):
+            before = time.time()
+            self.manifest = load_manifest(getattr(config, 'manifest_file',
+                os.path.join('save', 'manifest.pck')))
+            self.startup_times['manifest'] = time.time() - before
+        before = time.time()
+        self.rescan()
+        self.startup_times['plugins'] = time.time() - before
+        if self.workers is not None:
+            self.workers.start()
+        self.startup_times['total'] = time.time() - self.started
+        self.report_startup()
+
+    def rescan(self):
+        """
+        Loads new plugin modules, reloads those that have changed and unloads
+        those whose files have been deleted.
+
+        A module that fails to load is logged and its old plugins are kept.
+        Returns the dotted paths of the modules that were (re)loaded.
+        """
+        if hasattr(self.config, 'plugins'):
+            paths = list(self.config.plugins)
+        else:
+            paths = find_modules(getattr(self.config, 'plugin_dir',
+                'plugins'))
+        if self.workers is not None:
+            paths = [path for path in paths
+                if path not in self.workers.owners]
+        loaded = []
+        deferred = []
+        for path in paths:
+            if self.manifest is not None:
+                was_deferred = path in self.lazy
+                if self.defer_module(path):
+                    if not was_deferred:
+                        deferred.append(path)
+                    continue
+            try:
+                before = time.time()
+                if self.load_plugins_from_path(path, rebuild=False):
+                    loaded.append(path)
+                    self.import_times[path] = time.time() - before
+            except Exception:
+                self.log.exception('failed to load ' + path)
+                # Don't retry until the file changes again
+                module = sys.modules.get(path)
+                if module is not None:
+                    self.mtimes[path] = source_mtime(module)
+        removed = [path for path in self.mtimes if path not in paths and
+            source_mtime(sys.modules.get(path)) is None]
+        removed.extend(path for path in self.lazy if path not in paths and
+            module_mtime(path) is None)
+        for path in removed:
+            self.unload_module(path, rebuild=False)
+        if loaded or deferred or removed:
+            self.build_dispatch()
+        self.save_manifest()
+        return loaded
+
+    def defer_module(self, path):
+        """
+        Stands in for the plugins of a module that hasn't been imported with
+        LazyPlugins, if the manifest describes its current source. Returns
+        whether the module is left unimported.
+        """
+        mtime = module_mtime(path)
+        if path in self.lazy:
+            if self.lazy[path] == mtime:
+                return True
+            # Changed since it was deferred, so import it now
+            del self.lazy[path]
+            return False
+        if mtime is None or path in sys.modules:
+            return False
+        entry = self.manifest.get(path)
+        if entry is None or entry[0] != mtime:
+            return False
+        for description in entry[1]:
+            self.load_plugin(LazyPlugin(self, path, *description),
+                rebuild=False)
+        self.lazy[path] = mtime
+        # Jobs are armed by loading their plugins, so import the module in
+        # time for the earliest
+        wake = entry[2] if len(entry) > 2 else None
+        if wake is not None:
+            self.scheduler.clock.callLater(max(0., wake - time.time()),
+                self.wake, path)
+        return True
+
+    def wake(self, path):
+        """Imports a deferred module whose plugins have a job due."""
+        try:
+            self.realize(path)
+        except Exception:
+            self.log.exception('failed to load ' + path)
+
+    def realize(self, path):
+        """Imports a module whose plugins were deferred, if it still is."""
+        if path not in self.lazy:
+            return
+        del self.lazy[path]
+        before = time.time()
+        try:
+            self.load_plugins_from_path(path)
+        except Exception:
+            # Import it the usual way from now on, so it isn't retried for
+            # every signal
+            self.manifest.pop(path, None)
+            self.manifest_changed = True
+            raise
+        self.import_times[path] = time.time() - before
+        self.log.info('imported deferred module %s in %.3fs' %
+            (path, self.import_times[path]))
+
+    def load_deferred(self):
+        """
+        Imports the modules whose plugins were deferred, one at a time
+        between other work. Returns a Deferred that fires once they're all
+        imported.
+        """
+        started = time.time()
+        paths = sorted(self.lazy)
+        def load():
+            for path in paths:
+                try:
+                    self.realize(path)
+                except Exception:
+                    self.log.exception('failed to load ' + path)
+                yield None
+        d = task.coiterate(load())
+        d.addCallback(lambda ignored: self.log.info(
+            'imported %d deferred modules in the background in %.3fs' %
+                (len(paths), time.time() - started)))
+        return d
+
+    def save_manifest(self):
+        """
+        Writes the manifest of plugin modules if it has changed, noting when
+        each imported module's plugins next have a job due.
+        """
+        if self.manifest is None:
+            return
+        modules = {}
+        for plugin in self.plugins:
+            modules.setdefault(module_of(plugin), []).append(plugin)
+        for path, entry in self.manifest.items():
+            if path in self.lazy or path not in modules:
+                continue
+            wake = next_job(modules[path])
+            if entry[2:] != (wake,):
+                self.manifest[path] = (entry[0], entry[1], wake)
+                self.manifest_changed = True
+        if not self.manifest_changed:
+            return
+        self.manifest_changed = False
+        path = getattr(self.config, 'manifest_file',
+            os.path.join('save', 'manifest.pck'))
+        try:
+            save_manifest(path, self.manifest)
+        except (IOError, OSError):
+            self.log.exception('failed to write ' + path)
+
+    def report_startup(self):
+        """Logs how long loading plugins took, and what was deferred."""
+        times = self.startup_times
+        imported = sum(self.import_times.values())
+        message = 'started in %.3fs: plugins %.3fs (imports %.3fs)' % (
+            times['total'], times['plugins'], imported)
+        if 'manifest' in times:
+            message += ', manifest %.3fs' % times['manifest']
+        message += '; %d modules imported' % len(self.import_times)
+        if self.lazy:
+            message += ', %d deferred (%d plugins)' % (len(self.lazy),
+                len([plugin for plugin in self.plugins
+                    if isinstance(plugin, LazyPlugin)]))
+        self.log.info(message)
+        slowest = sorted(self.import_times.items(),
+            key=lambda item: item[1], reverse=True)[:5]
+        if slowest:
+            self.log.info('slowest imports: ' + ', '.join('%s %.3fs' % item
+                for item in slowest))
+
+    def signedon(self):
+        """
+        Called by Cassium on signing on. The first time, reports how long
+        that took and starts importing any deferred modules.
+        """
+        if self.signon_time is not None:
+            return
+        self.signon_time = time.time() - self.started
+        self.log.info('signed on %.3fs after starting' % self.signon_time)
+        if self.lazy and getattr(self.config, 'lazy_background', True):
+            self.load_deferred()
+
+    def watch(self, interval):
+        """
+        Starts reloading plugin modules as their files change.
+
+        Changes are picked up through inotify where available, or by
+        checking for them every `interval` seconds.
+        """
+        if self.watcher is None:
+            self.watcher = PluginWatcher(self, interval)
+            self.watcher.start()
+
+    def load_plugins_recursively(self, directory):
+        """
+        Recursively loads or reloads all plugins in the given directory.
+        
+        The plugins are always loaded in alphabetical order. Modules that
+        haven't changed since they were loaded are skipped. Returns the
+        dotted paths of the modules that were (re)loaded; the caller is
+        responsible for calling build_dispatch() if there are any.
+        """
+        return [path for path in find_modules(directory)
+            if self.load_plugins_from_path(path, rebuild=False)]
+
+    def load_plugins_from_path(self, path, force=False, rebuild=True):
+        """
+        Loads or reloads the plugin(s) at the given path.
+        
+        If the path points to a module, all plugins in the given module are
+        loaded. If the path points to a specific plugin within a module, that
+        plugin is loaded on its own.
+
+        A module that was loaded before is only reloaded if its source file
+        has changed since, unless `force` is true. The plugins being replaced
+        are saved first, so their replacements load their latest data, and
+        plugins no longer in the module are unloaded. Returns whether
+        anything was (re)loaded.
+        """
+        # Modules hosted by a worker are reloaded by restarting it
+        if self.workers is not None and path in self.workers.owners:
+            self.workers.owners[path].restart()
+            return True
+        this_plugin = sys.modules.get(path)
+        if (this_plugin is not None and not force and
+                self.mtimes.get(path, False) == source_mtime(this_plugin)):
+            return False
+        this_plugin = __import__(path)
+        # Navigate to the given path
+        for component in path.split('.')[1:]:
+            this_plugin = getattr(this_plugin, component)
+        if path in self.mtimes:
+            for plugin in self.plugins:
+                if plugin.__class__.__module__ == path:
+                    plugin.save()
+            # Drop the old classes, so that ones no longer in the module
+            # aren't found again after the reload
+            for attr, value in list(vars(this_plugin).items()):
+                if isclass(value) and value.__module__ == path:
+                    delattr(this_plugin, attr)
+            reload(this_plugin)
+        self.mtimes[path] = source_mtime(this_plugin)
+        # Find subclasses of Plugin and instantiate them, so that nothing is
+        # swapped in if one of them fails
+        new_plugins = []
+        for attr in dir(this_plugin):
+            this_attr = getattr(this_plugin, attr)
+            if (isclass(this_attr) and issubclass(this_attr, Plugin) and
+                    this_attr is not Plugin):
+                new_plugins.append(this_attr())
+        if not new_plugins:
+            self.log.warn('no plugins were found in the module ' + path)
+        self.lazy.pop(path, None)
+        if self.manifest is not None:
+            entry = (self.mtimes[path],
+                [describe(plugin) for plugin in new_plugins],
+                next_job(new_plugins))
+            if self.manifest.get(path) != entry:
+                self.manifest[path] = entry
+                self.manifest_changed = True
+        names = set(plugin.fqn() for plugin in new_plugins)
+        self.remove_plugins([plugin for plugin in self.plugins
+            if module_of(plugin) == path and plugin.fqn() not in names])
+        for plugin in new_plugins:
+            self.load_plugin(plugin, rebuild=False)
+        if rebuild:
+            self.build_dispatch()
+        return True
+
+    def unload_module(self, path, rebuild=True):
+        """Saves and unloads the plugins of a module that has been removed."""
+        self.mtimes.pop(path, None)
+        self.lazy.pop(path, None)
+        if self.manifest is not None and path in self.manifest:
+            del self.manifest[path]
+            self.manifest_changed = True
+        sys.modules.pop(path, None)
+        plugins = [plugin for plugin in self.plugins
+            if module_of(plugin) == path]
+        for plugin in plugins:
+            plugin.save()
+        self.remove_plugins(plugins)
+        if rebuild:
+            self.build_dispatch()
+
+    def remove_plugins(self, plugins):
+        """Removes plugin instances without rebuilding the dispatch table."""
+        if not plugins:
+            return
+        for plugin in plugins:
+            self.log.info('unloaded ' + plugin.fqn())
+        self.plugins = [plugin for plugin in self.plugins
+            if plugin not in plugins]
+        self.index = dict((plugin.fqn(), i)
+            for i, plugin in enumerate(self.plugins))
+
+    def load_remote_plugins(self, worker, plugins):
+        """Replaces the stand-ins for the plugins hosted by a worker."""
+        self.remove_plugins([plugin for plugin in self.plugins
+            if getattr(plugin, 'worker', None) is worker])
+        for plugin in plugins:
+            self.load_plugin(plugin, rebuild=False)
+        self.build_dispatch()
+
+    def load_plugin(self, plugin, rebuild=True):
+        """
+        Loads or reloads a plugin instance.
+
+        The dispatch table is rebuilt afterward unless `rebuild` is false, in
+        which case the caller is responsible for calling build_dispatch().
+        """
+        name = plugin.fqn()
+        # Insert logger and scheduler into plugin
+        plugin.log = logging.getLogger(name)
+        plugin._scheduler = self.scheduler
+        # Replace any existing copy of the plugin in place
+        i = self.index.get(name)
+        if i is not None:
+            replaced = self.plugins[i]
+            self.plugins[i] = plugin
+        else:
+            replaced = None
+            self.index[name] = len(self.plugins)
+            self.plugins.append(plugin)
+        if isinstance(plugin, LazyPlugin):
+            self.log.debug('deferred ' + name)
+        elif replaced is None or isinstance(replaced, LazyPlugin):
+            self.log.info('imported ' + name)
+        else:
+            self.log.info('reloaded ' + name)
+        self.scheduler.arm(plugin)
+        if rebuild:
+            self.build_dispatch()
+
+    def build_dispatch(self):
+        """
+        Rebuilds the table mapping each signal type to its handlers.
+
+        Each handler is stored as a (method, builtin) pair, where builtin
+        indicates that the method expects Cassium instead of a Response.
+        Message handlers are additionally indexed by their plugins' triggers.
+        """
+        handlers = {}
+        msg_entries = []
+        for plugin in self.plugins + self.builtin_plugins:
+            builtin = plugin in self.builtin_plugins
+            for signaltype in SIGNALS:
+                method = getattr(plugin, signaltype, None)
+                # Ensure the attribute we're looking at is a method
+                if hasattr(method, '__call__'):
+                    if self.profiler is not None:
+                        method = self.profiler.wrap(plugin.fqn(), signaltype,
+                            method)
+                    handlers.setdefault(signaltype, []).append(
+                        (method, builtin))
+                    if signaltype == 'msg':
+                        msg_entries.append((plugin, (method, builtin)))
+        self.handlers = handlers
+        self.triggers = TriggerIndex(msg_entries)
+
+    def run_job(self, plugin, job):
+        """
+        Runs a plugin's scheduled job on the connection to its network, or
+        any connection if it has none. Returns False if there is no such
+        connection.
+        """
+        when, interval, name, args, network = job
+        return self.run_call(JobCall(getattr(plugin, name), args), network)
+
+    def run_call(self, call, network):
+        """
+        Calls a job's handler on the connection to a network, as run_job()
+        does. Returns False if there is no such connection.
+        """
+        for cassium in self.connections:
+            if network is None or cassium.network == network:
+                cassium.run_job(call)
+                return True
+        return False
+
+    def save(self):
+        """Calls each plugin's save() method."""
+        for plugin in self.plugins:
+            plugin.save()
+        save_caches()
+        self.save_manifest()
+
+    def start_ticking(self):
+        """Starts ticking every tick_interval seconds, if not already."""
+        interval = getattr(self.config, 'tick_interval', 10.)
+        if interval and self.tick_timer is None:
+            self.tick_timer = task.LoopingCall(self.tick)
+            self.tick_timer.start(interval)
+
+    def tick(self):
+        """
+        Signals a tick on the first connection, once however many networks
+        Cassium is on, and starts an autosave if one is due.
+        """
+        # Most plugins schedule jobs instead, so ticks usually go nowhere
+        if 'tick' in self.handlers and self.connections:
+            self.connections[0].tick()
+        self.checkpoint()
+
+    def checkpoint(self):
+        """Starts an autosave if one is due."""
+        interval = getattr(self.config, 'autosave_interval', None)
+        if (interval and not self.autosaving and
+                time.time() - self.last_autosave >= interval):
+            self.autosave()
+
+    def autosave(self):
+        """
+        Saves every plugin's data without blocking the reactor.
+
+        Plugin data is snapshotted here, then serialized and written in a
+        worker thread. Plugins with their own save() method are saved here
+        instead. Returns a Deferred that fires once everything is written.
+        """
+        self.autosaving = True
+        self.last_autosave = time.time()
+        self.save_manifest()
+        snapshots = []
+        for plugin in self.plugins:
+            if type(plugin).save != Plugin.save:
+                plugin.save()
+            elif plugin.storage:
+                store = plugin.store()
+                snapshots.append((plugin.fqn(), store, store.next_sequence(),
+                    plugin.snapshot()))
+        d = threads.deferToThread(self.write_snapshots, snapshots)
+        def done(result):
+            self.autosaving = False
+            return result
+        d.addBoth(done)
+        d.addErrback(lambda failure: self.log.error('autosave failed: ' +
+            failure.getErrorMessage()))
+        return d
+
+    def write_snapshots(self, snapshots):
+        """Writes plugin snapshots to their stores. Runs in a thread."""
+        started = time.time()
+        total = 0
+        for name, store, sequence, snapshot in snapshots:
+            before = time.time()
+            try:
+                written = store.save(snapshot, sequence)
+            except Exception:
+                self.log.exception('autosave failed for ' + name)
+                continue
+            total += written
+            self.log.log(logging.INFO if written else logging.DEBUG,
+                'autosaved %s: %d bytes in %.3fs' %
+                (name, written, time.time() - before))
+        total += save_caches()
+        self.log.info('autosaved %d plugins: %d bytes in %.3fs' %
+            (len(snapshots), total, time.time() - started))
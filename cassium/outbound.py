@@ -0,0 +1,203 @@
+from collections import deque
+import logging
+
+from twisted.internet import reactor
+
+__all__ = ['TokenBucket', 'SendQueue']
+
+# The maximum length of an IRC line, including the trailing CRLF
+LINE_LIMIT = 512
+# Room left for the ":nick!user@host " prefix the server adds when relaying
+PREFIX_RESERVE = 100
+# IRC commands used for each kind of queued line
+COMMANDS = {'msg': 'PRIVMSG', 'notice': 'NOTICE', 'me': 'PRIVMSG',
+    'who': 'WHO'}
+# Kinds of line that may be merged while they wait
+MERGED = ('msg', 'notice')
+# Idle buckets are only pruned once there are more than this many
+BUCKET_SLACK = 256
+
+class TokenBucket(object):
+    """
+    A token bucket allowing `rate` events per second in bursts of `burst`.
+
+    `seconds` is a callable returning the current time.
+    """
+
+    def __init__(self, rate, burst, seconds):
+        self.rate = float(rate)
+        self.burst = burst
+        self.seconds = seconds
+        self.tokens = float(burst)
+        self.stamp = seconds()
+
+    def refill(self):
+        """Adds the tokens accrued since the last refill."""
+        now = self.seconds()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready(self):
+        """Returns whether a token is available."""
+        self.refill()
+        return self.tokens >= 1
+
+    def take(self):
+        """Consumes a token."""
+        self.tokens -= 1
+
+    def full(self):
+        """Returns whether the bucket has refilled completely."""
+        self.refill()
+        return self.tokens >= self.burst
+
+    def delay(self):
+        """Returns the number of seconds until a token is available."""
+        self.refill()
+        return max(0., (1 - self.tokens) / self.rate)
+
+
+class SendQueue(object):
+    """
+    Schedules outgoing messages, notices, actions and WHO queries.
+
+    Lines are queued per target and sent through `send(kind, target, text)`
+    as a server-wide and a per-target token bucket allow. Targets with queued
+    lines take turns, so one busy channel can't starve the others.
+    Consecutive messages or notices to the same target are merged with
+    `separator` while they wait, as long as the result fits on one IRC line;
+    a separator of None disables merging. Each target holds at most `limit`
+    lines, and lines beyond that are dropped.
+    """
+
+    def __init__(self, send, rate=1., burst=5, target_rate=.5,
+            target_burst=3, limit=100, separator=' | ', clock=reactor):
+        self.send = send
+        self.clock = clock
+        self.server = TokenBucket(rate, burst, clock.seconds)
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.limit = limit
+        self.separator = separator
+        self.queues = {}        # Target -> deque of (kind, text)
+        self.buckets = {}       # Target -> TokenBucket
+        self.order = deque()    # Targets with queued lines, in turn order
+        self.call = None
+        self.log = logging.getLogger(__name__)
+        # Counters
+        self.depth = 0
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def budget(self, kind, target):
+        """Returns the longest text that fits on one line to the target."""
+        return (LINE_LIMIT - PREFIX_RESERVE -
+            len('%s %s :\r\n' % (COMMANDS[kind], target)))
+
+    def put(self, kind, target, text):
+        """
+        Queues a line of the given kind ('msg', 'notice', 'me' or 'who',
+        whose text is ignored).
+        """
+        if isinstance(text, unicode):
+            text = text.encode('UTF-8')
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = self.queues[target] = deque()
+            self.order.append(target)
+            if target not in self.buckets:
+                self.buckets[target] = TokenBucket(self.target_rate,
+                    self.target_burst, self.clock.seconds)
+        # Merge short lines into the one waiting before them
+        if (self.separator is not None and queue and kind in MERGED and
+                '\n' not in text):
+            last_kind, last_text = queue[-1]
+            if last_kind == kind and '\n' not in last_text:
+                merged = last_text + self.separator + text
+                if len(merged) <= self.budget(kind, target):
+                    queue[-1] = (kind, merged)
+                    self.merged += 1
+                    return
+        if len(queue) >= self.limit:
+            self.dropped += 1
+            return
+        queue.append((kind, text))
+        self.depth += 1
+        self.schedule()
+
+    def schedule(self):
+        """Arranges for pump() to run when the next line may be sent."""
+        if self.call is not None or not self.order:
+            return
+        delay = max(self.server.delay(),
+            min(self.buckets[target].delay() for target in self.order))
+        self.call = self.clock.callLater(delay, self.pump)
+
+    def pump(self):
+        """Sends as many queued lines as the rate limits allow."""
+        self.call = None
+        try:
+            self.drain()
+        finally:
+            if len(self.buckets) > len(self.queues) + BUCKET_SLACK:
+                self.prune()
+            self.schedule()
+
+    def drain(self):
+        # Number of consecutive targets skipped for lack of tokens
+        skipped = 0
+        while self.order and skipped < len(self.order):
+            if not self.server.ready():
+                break
+            target = self.order.popleft()
+            bucket = self.buckets[target]
+            if not bucket.ready():
+                self.order.append(target)
+                skipped += 1
+                continue
+            skipped = 0
+            queue = self.queues[target]
+            kind, text = queue.popleft()
+            if queue:
+                self.order.append(target)
+            else:
+                del self.queues[target]
+            self.depth -= 1
+            self.server.take()
+            bucket.take()
+            try:
+                self.send(kind, target, text)
+            except Exception:
+                # One bad line mustn't hold up everything queued after it
+                self.log.exception('failed to send %s to %s' % (kind, target))
+                self.dropped += 1
+                continue
+            self.sent += 1
+
+    def prune(self):
+        """Forgets the buckets of idle targets that have fully refilled."""
+        for target, bucket in list(self.buckets.items()):
+            if target not in self.queues and bucket.full():
+                del self.buckets[target]
+
+    def stop(self):
+        """Cancels any pending send and discards all queued lines."""
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.dropped += self.depth
+        self.depth = 0
+        self.queues.clear()
+        self.order.clear()
+
+    def stats(self):
+        """Returns a dict of queue depth and counters."""
+        return {
+            'depth': self.depth,
+            'targets': len(self.queues),
+            'sent': self.sent,
+            'merged': self.merged,
+            'dropped': self.dropped,
+        }
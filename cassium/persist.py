@@ -0,0 +1,231 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+from threading import Lock
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+__all__ = ['PickleStore', 'SqliteStore', 'STORES', 'get_store']
+
+def encode(state):
+    """Pickles each value of a state dict separately."""
+    return dict((name, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        for name, value in state.items())
+
+def decode(encoded):
+    """Unpickles each value of an encoded state dict."""
+    return dict((name, pickle.loads(data)) for name, data in encoded.items())
+
+def digest(encoded):
+    """Returns a digest of each value of an encoded state dict."""
+    return dict((name, hashlib.sha1(data).digest())
+        for name, data in encoded.items())
+
+def atomic_write(path, data):
+    """
+    Writes data to a file by way of a temporary file and a rename.
+
+    A crash mid-write leaves either the old or the new file, never a
+    truncated one.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(path)
+            os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+class Store(object):
+    """
+    The base class for plugin data stores.
+
+    A store remembers a digest of the data it last saved or loaded, so saving
+    unchanged data writes nothing. This isn't dirty tracking: nothing notices
+    data being changed in place, so every save still pickles and hashes all
+    of the data, at a cost proportional to its size. Autosaves pay it in a
+    worker thread, but Plugin.save(), as used on reload or `save, pays it on
+    the reactor thread.
+
+    Each save is numbered when its state is taken (see next_sequence()), and
+    a save numbered before one already written is dropped, so a snapshot
+    written late by a thread can't overwrite newer data. Plugins get their
+    store through get_store(), so a reloaded plugin shares its
+    predecessor's.
+    """
+
+    extension = None
+
+    def __init__(self, base):
+        self.path = base + self.extension
+        self.legacy = base + '.pck'
+        self.lock = Lock()
+        self.sequence = 0   # The last number handed out
+        self.saved = 0      # The number of the last save written
+
+    def next_sequence(self):
+        """Numbers a save whose state is being taken now."""
+        with self.lock:
+            self.sequence += 1
+            return self.sequence
+
+    def load(self):
+        """Returns the saved state dict, which is empty if there is none."""
+        raise NotImplementedError
+
+    def save(self, state, sequence=None):
+        """
+        Saves a state dict if it differs from what was last saved, unless
+        a newer save has already been written. `sequence` is the save's
+        number from next_sequence(), if it was taken earlier.
+
+        Returns the number of bytes written.
+        """
+        if sequence is None:
+            sequence = self.next_sequence()
+        with self.lock:
+            if sequence < self.saved:
+                return 0
+            self.saved = sequence
+            return self.write(state)
+
+    def write(self, state):
+        """
+        Writes a state dict if it has changed, returning the bytes written.
+        Called with the lock held.
+        """
+        raise NotImplementedError
+
+    def read_pickle(self):
+        """
+        Reads the plugin's pickle file.
+
+        Returns the file's contents and the state it holds, or None and an
+        empty dict if there is no file.
+        """
+        if not os.path.isfile(self.legacy):
+            return None, {}
+        with open(self.legacy, 'rb') as sf:
+            data = sf.read()
+        return data, pickle.loads(data)
+
+
+class PickleStore(Store):
+    """
+    Stores a plugin's data in a single pickle file.
+
+    The whole state is pickled at once, so objects shared between
+    attributes are still shared once loaded, and the file is rewritten
+    atomically when the pickle's digest differs from the last one's.
+    """
+
+    extension = '.pck'
+    # A digest of the pickle last saved or loaded
+    digest = None
+
+    def load(self):
+        data, state = self.read_pickle()
+        if data is not None:
+            self.digest = hashlib.sha1(data).digest()
+        return state
+
+    def write(self, state):
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(data).digest()
+        if digest == self.digest:
+            return 0
+        atomic_write(self.path, data)
+        self.digest = digest
+        return len(data)
+
+
+class SqliteStore(Store):
+    """
+    Stores a plugin's data in an sqlite database, one row per attribute.
+
+    Only changed attributes are written, in a single transaction. If no
+    database exists yet, data is loaded from the plugin's pickle file.
+    Attributes are pickled separately, so an object shared between two
+    attributes is loaded as two copies; plugins that rely on such sharing
+    should use the pickle store.
+    """
+
+    extension = '.db'
+    # Digests of each attribute last saved or loaded
+    digests = {}
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE IF NOT EXISTS state '
+            '(name TEXT PRIMARY KEY, value BLOB)')
+        return db
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            # Nothing is in the database yet, so everything will be written
+            return self.read_pickle()[1]
+        db = self.connect()
+        try:
+            encoded = dict((name, bytes(value))
+                for name, value in db.execute('SELECT name, value FROM state'))
+        finally:
+            db.close()
+        self.digests = digest(encoded)
+        return decode(encoded)
+
+    def write(self, state):
+        encoded = encode(state)
+        digests = digest(encoded)
+        if digests == self.digests:
+            return 0
+        changed = dict((name, data) for name, data in encoded.items()
+            if self.digests.get(name) != digests[name])
+        removed = [name for name in self.digests if name not in digests]
+        written = self.write_rows(changed, removed)
+        self.digests = digests
+        return written
+
+    def write_rows(self, changed, removed):
+        """Writes changed attributes and deletes removed ones."""
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                    [(name, sqlite3.Binary(data))
+                        for name, data in changed.items()])
+                db.executemany('DELETE FROM state WHERE name = ?',
+                    [(name,) for name in removed])
+        finally:
+            db.close()
+        return sum(len(data) for data in changed.values())
+
+
+# Store classes by the name used in Plugin.storage
+STORES = {'pickle': PickleStore, 'sqlite': SqliteStore}
+
+# Stores by path, kept for the life of the process
+stores = {}
+stores_lock = Lock()
+
+def get_store(storage, base):
+    """Gets the store of the given kind for a path, creating it if need be."""
+    cls = STORES[storage]
+    with stores_lock:
+        store = stores.get(base + cls.extension)
+        if store is None:
+            store = stores[base + cls.extension] = cls(base)
+        return store
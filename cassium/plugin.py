@@ -1,17 +1,69 @@
+import copy
 import os
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 import re
+import time
+
+from twisted.internet import threads
+
+from cache import Cache, get_cache, memoize
+from persist import get_store
 
 # Do not expose imported modules
-__all__ = ['Plugin', 'DisabledPlugin', 'Query', 'Response']
+__all__ = ['Plugin', 'DisabledPlugin', 'Query', 'Response', 'blocking',
+    'Cache', 'memoize']
+
+def blocking(method=None, timeout=None):
+    """
+    Marks a signal handler as blocking.
+
+    Blocking handlers are run in a thread pool instead of on the reactor
+    thread, so slow I/O doesn't stall the bot. Their responses are sent once
+    they return, in the order the triggering events arrived. Use either
+    @blocking or @blocking(timeout=seconds); the default timeout is the
+    plugin_timeout configuration value.
+    """
+    def mark(method):
+        method.blocking = True
+        method.timeout = timeout
+        return method
+    if method is None:
+        return mark
+    return mark(method)
+
+def run_blocking(method, query, response):
+    """
+    Runs a blocking handler in the reactor's thread pool.
+
+    The handler gets a Response of its own, which is merged into the event's
+    Response once it returns. Returns a Deferred that fires at that point.
+    """
+    forked = response._fork()
+    d = threads.deferToThread(method, query, forked)
+    d.addCallback(lambda result: response._merge(forked))
+    return d
 
 class Plugin(object):
     """The base class for all Cassium plugins."""
 
     log = None
+    # Set by the plugin manager
+    _scheduler = None
+
+    # How the plugin's data is persisted: 'pickle' rewrites one file whenever
+    # anything changes, 'sqlite' only writes the attributes that changed, and
+    # None disables persistence
+    storage = 'pickle'
+    # Attributes that are never persisted, in addition to log
+    transient = ()
+    # Whether the plugin may be run in a worker process. Plugins that use
+    # query.state or query.history can't be, as workers have neither
+    in_workers = True
+
+    # Message triggers. If any are declared, msg() is only called for
+    # messages that match at least one of them.
+    commands = ()   # Exact first words, e.g. ('!hello',)
+    prefixes = ()   # Message prefixes, e.g. ('!',)
+    patterns = ()   # Regular expressions searched for within the message
 
     def __init__(self):
         self.load()
@@ -26,29 +78,126 @@ class Plugin(object):
 
     def savefile(self):
         """Gets the path to the plugin's save file."""
-        return os.path.join('save', self.fqn() + '.pck')
+        return self.store().path
+
+    def store(self):
+        """Gets the plugin's data store, creating it on first use."""
+        store = self.__dict__.get('_store')
+        if store is None:
+            base = os.path.join('save', self.fqn())
+            store = self._store = get_store(self.storage, base)
+        return store
+
+    def state(self):
+        """Gets a dict of the plugin's data to be persisted."""
+        return dict((k, v) for k, v in self.__dict__.items()
+            if k not in ('log', '_store', '_scheduler') and
+                k not in self.transient)
+
+    def snapshot(self):
+        """
+        Gets a copy of the plugin's data that can be saved from another thread.
+
+        Top-level lists, dicts and sets are copied, but anything nested inside
+        them is shared. Plugins that mutate nested data in place should
+        override this to copy it too. Attributes that share a container, or
+        hold one another directly, still do in the copy.
+        """
+        state = self.state()
+        copies = {}     # id of each original container -> its copy
+        for name, value in state.items():
+            if isinstance(value, (list, dict, set)):
+                if id(value) not in copies:
+                    copies[id(value)] = copy.copy(value)
+                state[name] = copies[id(value)]
+        for value in copies.values():
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    if id(item) in copies:
+                        value[key] = copies[id(item)]
+            elif isinstance(value, list):
+                for i, item in enumerate(value):
+                    if id(item) in copies:
+                        value[i] = copies[id(item)]
+        return state
 
     def load(self):
         """Loads the plugin's data from its savefile."""
-        savefile = self.savefile()
-        if os.path.isfile(savefile):
-            with open(savefile, 'r') as sf:
-                self.__dict__.update(pickle.load(sf))
+        if self.storage:
+            self.__dict__.update(self.store().load())
 
     def save(self):
         """
         Saves the plugin's data to its savefile.
         
-        This method is called when Cassium reconnects or restarts. To disable
-        data persistence for a plugin, give it a save() method that does
-        nothing. (You may also wish to override load() if the plugin has
-        saved its data before.)
+        This method is called when Cassium reconnects or restarts. Nothing is
+        written if the data hasn't changed since it was last saved or loaded,
+        but telling costs a full pickle of the data (see persist.Store).
+        To disable data persistence for a plugin, set its storage to None or
+        give it a save() method that does nothing. (You may also wish to
+        override load() if the plugin has saved its data before.)
+
+        Returns the number of bytes written.
+        """
+        if not self.storage:
+            return 0
+        return self.store().save(self.state())
+
+    def get_cache(self, name=None, limit=1000, ttl=None, persist=False):
+        """
+        Gets one of the plugin's caches, creating it if need be.
+
+        A cache holds at most `limit` items, evicting the least recently
+        used, and forgets items `ttl` seconds after they're set (never if
+        ttl is None). A cache with `persist` set is saved in its own file
+        when plugin data is. Caches outlive the plugin being reloaded, and
+        one kept as an attribute is saved with the plugin's data as a
+        reference only. See cassium.cache for more, including memoize().
+        """
+        if name is None:
+            name = self.fqn()
+        else:
+            name = self.fqn() + '.' + name
+        return get_cache(name, limit, ttl, persist)
+
+    def call_at(self, when, name, *args, **kwargs):
+        """
+        Schedules a call to one of the plugin's methods at a given time, in
+        seconds since the epoch.
+
+        The method is called as method(query, response, *args), where the
+        response is sent on the connection to the network given as the
+        `network` keyword argument, or any network by default. Scheduled jobs
+        are saved with the plugin's data, so they survive restarts; a job
+        whose time passed while Cassium was down runs once it's back.
+        Returns the job's id, or raises AttributeError if the plugin has no
+        such method.
+        """
+        return self._schedule(when, None, name, args, kwargs.get('network'))
+
+    def call_every(self, interval, name, *args, **kwargs):
+        """
+        Schedules a call to one of the plugin's methods every `interval`
+        seconds, starting `interval` seconds from now, as with call_at().
+        Returns the job's id.
         """
-        savefile = self.savefile()
-        with open(savefile, 'w') as sf:
-            dictdump = self.__dict__.copy()
-            del dictdump['log']
-            pickle.dump(dictdump, sf)
+        return self._schedule(time.time() + interval, interval, name, args,
+            kwargs.get('network'))
+
+    def cancel(self, job):
+        """Cancels a scheduled job."""
+        self.__dict__.get('_jobs', {}).pop(job, None)
+
+    def _schedule(self, when, interval, name, args, network):
+        if not hasattr(getattr(self, name, None), '__call__'):
+            raise AttributeError('%s has no method %r to schedule' %
+                (self.fqn(), name))
+        jobs = self.__dict__.setdefault('_jobs', {})
+        job = max(jobs) + 1 if jobs else 1
+        jobs[job] = [when, interval, name, args, network]
+        if self._scheduler is not None:
+            self._scheduler.add(self, job)
+        return job
 
     def __str__(self):
         return '<Plugin %s>' % self.__class__.__name__
@@ -69,21 +218,194 @@ class Query(object):
         * channel: the channel in which the privmsg was sent
         * message: the message string
         * words: the message as a list of space-separated words
+        * users: the nicknames of the users in a massjoin or massquit
+        * network: the name of the network the signal came from
+        * state: who is in each channel (see cassium.state.ChannelState)
+        * history: the index of what was said in channels, or None if it is
+          disabled (see cassium.history.History)
         * config: Cassium's configuration module
+
+    Query(channels, signaltype, **kwargs) creates an instance of the Query
+    subclass for the given signal type. Properties that don't apply to the
+    signal, or weren't given, are missing rather than None. Derived
+    properties such as words and nick are computed on first use. Other
+    keyword arguments, and attributes plugins set on a query, are kept in
+    its __dict__, which is only allocated once something is put in it.
     """
-    def __init__(self, channels, signaltype, **kwargs):
+
+    __slots__ = ('channels', 'type', 'network', 'state', 'history',
+        '__dict__')
+
+    def __new__(cls, channels, signaltype, **kwargs):
+        if cls is Query:
+            cls = QUERIES.get(signaltype, Query)
+        return object.__new__(cls)
+
+    def __init__(self, channels, signaltype, **extra):
+        # Cassium passes a shared frozenset, which this doesn't copy
         self.channels = frozenset(channels)
         self.type = signaltype
-        for k, v in kwargs.items():
-            # Translates to e.g. self.message = kwargs['message']
-            setattr(self, k, v)
-            if k == 'message':
-                self.words = v.split(' ')
-            elif k == 'user':
-                try:
-                    self.nick, self.host = v.split('!', 1)
-                except:
-                    self.nick = v
+        self.network = None
+        self.state = None
+        self.history = None
+        if extra:
+            self.__dict__.update(extra)
+
+
+# Marks a keyword argument that wasn't given
+MISSING = object()
+
+def words(query):
+    """The message as a list of space-separated words."""
+    try:
+        return query._words
+    except AttributeError:
+        query._words = query.message.split(' ')
+        return query._words
+
+def split_user(query):
+    """Splits the query's user into its nick and host."""
+    try:
+        query._nick, query._host = query.user.split('!', 1)
+    except Exception:
+        query._nick, query._host = query.user, None
+
+class ChannelQuery(Query):
+    """A Query for a signal that concerns a channel."""
+
+    __slots__ = ('channel',)
+
+    def __init__(self, channels, signaltype, channel=MISSING, **extra):
+        Query.__init__(self, channels, signaltype, **extra)
+        if channel is not MISSING:
+            self.channel = channel
+
+
+class UserQuery(ChannelQuery):
+    """A Query for a signal triggered by a user."""
+
+    __slots__ = ('user', '_nick', '_host')
+
+    def __init__(self, channels, signaltype, user=MISSING, channel=MISSING,
+            **extra):
+        ChannelQuery.__init__(self, channels, signaltype, channel, **extra)
+        if user is not MISSING:
+            self.user = user
+
+    @property
+    def nick(self):
+        try:
+            return self._nick
+        except AttributeError:
+            split_user(self)
+            return self._nick
+
+    @property
+    def host(self):
+        try:
+            host = self._host
+        except AttributeError:
+            split_user(self)
+            host = self._host
+        if host is None:
+            raise AttributeError('host')
+        return host
+
+
+class MessageQuery(UserQuery):
+    """A Query for a signal that carries a message from a user."""
+
+    __slots__ = ('message', '_words')
+
+    def __init__(self, channels, signaltype, user=MISSING, channel=MISSING,
+            message=MISSING, **extra):
+        UserQuery.__init__(self, channels, signaltype, user, channel, **extra)
+        if message is not MISSING:
+            self.message = message
+
+    words = property(words)
+
+
+class TopicQuery(UserQuery):
+    """A Query for a topic change."""
+
+    __slots__ = ('topic',)
+
+    def __init__(self, channels, signaltype, user=MISSING, channel=MISSING,
+            topic=MISSING, **extra):
+        UserQuery.__init__(self, channels, signaltype, user, channel, **extra)
+        if topic is not MISSING:
+            self.topic = topic
+
+
+class KickQuery(ChannelQuery):
+    """A Query for a user being kicked by another."""
+
+    __slots__ = ('kickee', 'kicker', 'message', '_words')
+
+    def __init__(self, channels, signaltype, kickee=MISSING, channel=MISSING,
+            kicker=MISSING, message=MISSING, **extra):
+        ChannelQuery.__init__(self, channels, signaltype, channel, **extra)
+        if kickee is not MISSING:
+            self.kickee = kickee
+        if kicker is not MISSING:
+            self.kicker = kicker
+        if message is not MISSING:
+            self.message = message
+
+    words = property(words)
+
+
+class NickQuery(Query):
+    """A Query for a nickname change."""
+
+    __slots__ = ('oldname', 'newname')
+
+    def __init__(self, channels, signaltype, oldname=MISSING,
+            newname=MISSING, **extra):
+        Query.__init__(self, channels, signaltype, **extra)
+        if oldname is not MISSING:
+            self.oldname = oldname
+        if newname is not MISSING:
+            self.newname = newname
+
+
+class MassQuery(ChannelQuery):
+    """
+    A Query for many users joining a channel, or quitting with the same
+    message, at once.
+    """
+
+    __slots__ = ('users', 'message', '_words')
+
+    def __init__(self, channels, signaltype, users=MISSING, channel=MISSING,
+            message=MISSING, **extra):
+        ChannelQuery.__init__(self, channels, signaltype, channel, **extra)
+        if users is not MISSING:
+            self.users = users
+        if message is not MISSING:
+            self.message = message
+
+    words = property(words)
+
+
+# Query classes by signal type
+QUERIES = {
+    'ijoin': ChannelQuery,
+    'ileft': ChannelQuery,
+    'ikick': MessageQuery,
+    'inick': NickQuery,
+    'msg': MessageQuery,
+    'join': UserQuery,
+    'leave': UserQuery,
+    'quit': MessageQuery,
+    'kick': KickQuery,
+    'action': MessageQuery,
+    'topic': TopicQuery,
+    'nick': NickQuery,
+    'massjoin': MassQuery,
+    'massquit': MassQuery,
+}
 
 
 class Response(object):
@@ -95,20 +417,60 @@ class Response(object):
     plugin then responds using the given methods.
     """
 
+    # Response values are allocated on first use, so a Response that nothing
+    # is queued on holds only its default target
+    _msg = None     # Duplicate messages permitted
+    _join = None    # Only makes sense to join a channel once at a time
+    _leave = None   # Same idea as _join
+    _kick = None    # Only one user kick per channel
+    _topic = None   # Same idea as _kick
+    _mode = None    # Too complex to restrict meaningfully
+    _notice = None  # Same idea as _msg
+    _nick = None    # You're either changing it or you're not
+    _me = None      # Same idea as _msg
+    _log = None     # Same idea as _msg
+    # Whether anything has been queued
+    _queued = False
+
     def __init__(self, defaulttarget):
         self._defaulttarget = defaulttarget
 
-        # Initialize response values
-        self._msg = []      # Duplicate messages permitted
-        self._join = set()  # Only makes sense to join a channel once at a time
-        self._leave = set() # Same idea as _join
-        self._kick = {}     # Only one user kick per channel
-        self._topic = {}    # Same idea as _kick
-        self._mode = []     # Too complex to restrict meaningfully
-        self._notice = []   # Same idea as _msg
-        self._nick = None   # You're either changing it or you're not
-        self._me = []       # Same idea as _msg
-        self._log = []      # Same idea as _msg
+    def _bucket(self, name, factory):
+        """Gets one of the response values, allocating it on first use."""
+        bucket = self.__dict__.get(name)
+        if bucket is None:
+            bucket = self.__dict__[name] = factory()
+            self._queued = True
+        return bucket
+
+    def _fork(self):
+        """Creates an empty Response with the same default target."""
+        return Response(self._defaulttarget)
+
+    def _merge(self, other):
+        """Queues everything from another Response on this one."""
+        if not other._queued:
+            return
+        if other._msg:
+            self._bucket('_msg', list).extend(other._msg)
+        if other._join:
+            self._bucket('_join', set).update(other._join)
+        if other._leave:
+            self._bucket('_leave', set).update(other._leave)
+        if other._kick:
+            self._bucket('_kick', dict).update(other._kick)
+        if other._topic:
+            self._bucket('_topic', dict).update(other._topic)
+        if other._mode:
+            self._bucket('_mode', list).extend(other._mode)
+        if other._notice:
+            self._bucket('_notice', list).extend(other._notice)
+        if other._nick:
+            self.nick(other._nick)
+        if other._me:
+            self._bucket('_me', list).extend(other._me)
+        if other._log:
+            self._bucket('_log', list).extend(other._log)
 
     def _target(self, target):
         return target or self._defaulttarget
@@ -116,27 +478,28 @@ class Response(object):
     def msg(self, message, target=None):
         """Send a PRIVMSG to a target, or to the source of the query
         (a channel or user) if no target is specified."""
-        self._msg.append((self._target(target), message))
+        self._bucket('_msg', list).append((self._target(target), message))
 
     def msgs(self, messages, target=None):
         """Send a list of messages to a target."""
-        self._msg.extend([(self._target(target), m) for m in messages])
+        self._bucket('_msg', list).extend(
+            [(self._target(target), m) for m in messages])
  
     def join(self, channel, key=None):
         """Join a channel."""
-        self._join.add((channel, key))
+        self._bucket('_join', set).add((channel, key))
 
     def leave(self, channel, reason=None):
         """Part from a channel."""
-        self._leave.add((channel, reason))
+        self._bucket('_leave', set).add((channel, reason))
 
     def kick(self, channel, user, reason=None):
         """Kick a user."""
-        self._kick[(channel, user)] = reason
+        self._bucket('_kick', dict)[(channel, user)] = reason
 
     def topic(self, channel, topic):
         """Set a channel's topic."""
-        self._topic[channel] = topic
+        self._bucket('_topic', dict)[channel] = topic
 
     def mode(self, channel, set_, modes, limit=None, user=None, mask=None):
         """
@@ -145,20 +508,22 @@ class Response(object):
         For more details, see Twisted's documentation on the method:
         http://twistedmatrix.com/documents/8.2.0/api/twisted.words.protocols.irc.IRCClient.html#mode
         """
-        self._mode.append((channel, set_, modes, limit, user, mask))
+        self._bucket('_mode', list).append(
+            (channel, set_, modes, limit, user, mask))
 
     def notice(self, user, message):
         """Send a user a notice."""
-        self._notice.append((user, message))
+        self._bucket('_notice', list).append((user, message))
 
     def nick(self, nick):
         """Change the bot's nickname."""
         self._nick = nick
+        self._queued = True
 
     def me(self, channel, action):
         """Send an action ("/me" command) to a channel."""
-        self._me.append((channel, action))
+        self._bucket('_me', list).append((channel, action))
 
     def log(self, msg):
         """Log a message to the console."""
-        self._log.append(msg)
+        self._bucket('_log', list).append(msg)
@@ -0,0 +1,139 @@
+import heapq
+from itertools import count
+import logging
+
+from twisted.internet import reactor
+
+__all__ = ['Scheduler']
+
+class JobCall(object):
+    """
+    A scheduled call to a plugin's method, passed to Cassium like a handler.
+
+    It carries the attributes Cassium looks for on handlers, and calls the
+    method with the job's arguments after the query and response.
+    """
+
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.__self__ = method.__self__
+        self.__name__ = method.__name__
+        self.blocking = getattr(method, 'blocking', False)
+        self.timeout = getattr(method, 'timeout', None)
+
+    def __call__(self, query, response):
+        return self.method(query, response, *self.args)
+
+
+class Scheduler(object):
+    """
+    Calls plugins' scheduled jobs at their times.
+
+    Jobs live in their plugins' data, as job id -> [time, interval, method
+    name, args, network], and the scheduler keeps a heap of (time, sequence,
+    plugin name, job id) entries with a single timer armed for the earliest.
+    Cancelled and rescheduled jobs leave stale entries behind, which are
+    recognized by their time and skipped when they come up, so each change
+    costs O(log n) and nothing is ever scanned.
+    """
+
+    def __init__(self, manager, clock=reactor):
+        self.manager = manager
+        self.clock = clock
+        self.log = logging.getLogger(__name__)
+        self.heap = []
+        self.sequence = count()
+        self.call = None
+        # Jobs that came due while Cassium wasn't signed on
+        self.waiting = []
+        # Calls from jobs run elsewhere, e.g. in a worker, waiting likewise
+        self.waiting_calls = []
+
+    def add(self, plugin, job):
+        """Arranges for one of a plugin's jobs to run at its time."""
+        when = plugin._jobs[job][0]
+        heapq.heappush(self.heap, (when, next(self.sequence), plugin.fqn(),
+            job))
+        if self.heap[0][0] == when:
+            self.schedule()
+
+    def arm(self, plugin):
+        """Arranges for all of a newly loaded plugin's jobs to run."""
+        now = self.clock.seconds()
+        for job, (when, interval, name, args, network) in list(
+                plugin.__dict__.get('_jobs', {}).items()):
+            if interval and when < now:
+                # Run a repeating job that was missed once, right away, and
+                # then keep to its original phase
+                missed = (now - when) // interval
+                plugin._jobs[job] = [when + missed * interval, interval,
+                    name, args, network]
+            self.add(plugin, job)
+
+    def schedule(self):
+        """Sets the timer for the earliest entry in the heap."""
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if self.heap:
+            delay = max(0., self.heap[0][0] - self.clock.seconds())
+            self.call = self.clock.callLater(delay, self.run)
+
+    def run(self):
+        """Runs every job that is due."""
+        self.call = None
+        now = self.clock.seconds()
+        while self.heap and self.heap[0][0] <= now:
+            when, sequence, name, job = heapq.heappop(self.heap)
+            i = self.manager.index.get(name)
+            if i is None:
+                continue
+            plugin = self.manager.plugins[i]
+            entry = plugin.__dict__.get('_jobs', {}).get(job)
+            # Skip entries for jobs since cancelled or rescheduled
+            if entry is None or entry[0] != when:
+                continue
+            try:
+                ran = self.manager.run_job(plugin, entry)
+            except Exception:
+                # e.g. the method was renamed by a reload; drop the job
+                # rather than leave the timer unset
+                self.log.exception('dropped job %d of %s' % (job, name))
+                del plugin._jobs[job]
+                continue
+            if not ran:
+                self.waiting.append((name, job))
+                continue
+            interval = entry[1]
+            if interval:
+                # Skip any runs this one was too late for
+                plugin._jobs[job] = [when + interval *
+                    (1 + (now - when) // interval)] + entry[1:]
+            else:
+                del plugin._jobs[job]
+                continue
+            self.add(plugin, job)
+        self.schedule()
+
+    def defer_call(self, call, network):
+        """Holds a job's call until Cassium is signed on to its network."""
+        self.waiting_calls.append((call, network))
+
+    def resume(self):
+        """Runs the jobs that were waiting for Cassium to sign on."""
+        calls, self.waiting_calls = self.waiting_calls, []
+        for call, network in calls:
+            if not self.manager.run_call(call, network):
+                self.waiting_calls.append((call, network))
+        waiting, self.waiting = self.waiting, []
+        now = self.clock.seconds()
+        for name, job in waiting:
+            i = self.manager.index.get(name)
+            if i is None:
+                continue
+            plugin = self.manager.plugins[i]
+            entry = plugin.__dict__.get('_jobs', {}).get(job)
+            if entry is not None:
+                plugin._jobs[job] = [now] + entry[1:]
+                self.add(plugin, job)
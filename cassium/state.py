@@ -0,0 +1,177 @@
+import string
+
+__all__ = ['ChannelState', 'irc_lower']
+
+# Nicks and channels compare case-insensitively, with []\~ being the
+# uppercase forms of {}|^ (RFC 1459)
+LOWER = string.maketrans(string.ascii_uppercase + '[]\\~',
+    string.ascii_lowercase + '{}|^')
+# Prefixes NAMES replies put on nicks to show their channel modes
+NICK_PREFIXES = '@+%&~!'
+
+def irc_lower(name):
+    """Lowercases a nick or channel name for comparison."""
+    if isinstance(name, unicode):
+        return name.lower()
+    return name.translate(LOWER)
+
+
+class ChannelState(object):
+    """
+    Who is in each of Cassium's channels on one network, and their hosts.
+
+    Cassium keeps this up to date from joins, parts, quits, kicks, nick
+    changes and NAMES and WHO replies, and passes it to plugins as
+    `query.state`. Plugins should only use the methods below; the ones
+    prefixed with an underscore are for Cassium. Lookups are by nick or
+    channel in any case, and return names as last seen.
+
+    Joins and nick changes are applied before plugins are signalled, while
+    parts, quits and kicks are applied afterward, so a handler can still
+    look up the channels a quitting user was in.
+    """
+
+    def __init__(self):
+        self._members = {}      # Channel -> {nick: nick as last seen}
+        self._channels = {}     # Nick -> set of channels
+        self._hosts = {}        # Nick -> user@host
+        self._names = {}        # Channel -> channel as last seen
+        self._pending = {}      # Channel -> NAMES reply being received
+        # Frozen results, until the channel or nick changes
+        self._frozen_members = {}
+        self._frozen_channels = {}
+
+    def members(self, channel):
+        """Gets the nicks in a channel as a frozenset."""
+        channel = irc_lower(channel)
+        members = self._frozen_members.get(channel)
+        if members is None:
+            members = self._frozen_members[channel] = frozenset(
+                self._members.get(channel, {}).values())
+        return members
+
+    def channels_of(self, nick):
+        """Gets the channels a nick shares with Cassium as a frozenset."""
+        nick = irc_lower(nick)
+        channels = self._frozen_channels.get(nick)
+        if channels is None:
+            channels = self._frozen_channels[nick] = frozenset(
+                self._names[channel]
+                for channel in self._channels.get(nick, ()))
+        return channels
+
+    def is_on(self, nick, channel):
+        """Returns whether a nick is in a channel."""
+        return irc_lower(nick) in self._members.get(irc_lower(channel), ())
+
+    def host(self, nick):
+        """Gets a nick's user@host, or None if it isn't known."""
+        return self._hosts.get(irc_lower(nick))
+
+    def channels(self):
+        """Gets the channels being tracked."""
+        return frozenset(self._names.values())
+
+    def _add(self, nick, channel):
+        key = irc_lower(nick)
+        self._members[channel][key] = nick
+        self._channels.setdefault(key, set()).add(channel)
+        self._frozen_members.pop(channel, None)
+        self._frozen_channels.pop(key, None)
+
+    def _remove(self, key, channel):
+        """Removes a lowercased nick from a lowercased channel."""
+        self._members[channel].pop(key, None)
+        self._frozen_members.pop(channel, None)
+        self._frozen_channels.pop(key, None)
+        channels = self._channels.get(key)
+        if channels is not None:
+            channels.discard(channel)
+            # Forget nicks no longer seen anywhere
+            if not channels:
+                del self._channels[key]
+                self._hosts.pop(key, None)
+
+    def _seen(self, user):
+        """Records the host of a nick!user@host, if the nick is tracked."""
+        nick, sep, host = user.partition('!')
+        key = irc_lower(nick)
+        if sep and key in self._channels:
+            self._hosts[key] = host
+
+    def _joined(self, channel):
+        """Starts tracking a channel Cassium joined."""
+        key = irc_lower(channel)
+        self._names[key] = channel
+        self._members.setdefault(key, {})
+        self._frozen_members.pop(key, None)
+
+    def _left(self, channel):
+        """Stops tracking a channel Cassium left or was kicked from."""
+        key = irc_lower(channel)
+        if key not in self._members:
+            return
+        for nick in list(self._members[key]):
+            self._remove(nick, key)
+        del self._members[key]
+        del self._names[key]
+        self._pending.pop(key, None)
+
+    def _user_joined(self, user, channel):
+        key = irc_lower(channel)
+        if key in self._members:
+            self._add(user.partition('!')[0], key)
+            self._seen(user)
+
+    def _user_left(self, nick, channel):
+        key = irc_lower(channel)
+        if key in self._members:
+            self._remove(irc_lower(nick), key)
+
+    def _user_quit(self, nick):
+        key = irc_lower(nick)
+        for channel in list(self._channels.get(key, ())):
+            self._remove(key, channel)
+
+    def _user_renamed(self, oldname, newname):
+        old, new = irc_lower(oldname), irc_lower(newname)
+        channels = self._channels.pop(old, None)
+        host = self._hosts.pop(old, None)
+        self._frozen_channels.pop(old, None)
+        if channels is None:
+            return
+        for channel in channels:
+            self._members[channel].pop(old, None)
+            self._members[channel][new] = newname
+            self._frozen_members.pop(channel, None)
+        self._channels[new] = channels
+        self._frozen_channels.pop(new, None)
+        if host is not None:
+            self._hosts[new] = host
+
+    def _names_reply(self, channel, names):
+        """Collects the nicks in one line of a NAMES reply (353)."""
+        key = irc_lower(channel)
+        if key in self._members:
+            self._pending.setdefault(key, []).extend(
+                name.lstrip(NICK_PREFIXES) for name in names.split())
+
+    def _names_end(self, channel):
+        """Replaces a channel's members with a complete NAMES reply (366)."""
+        key = irc_lower(channel)
+        nicks = self._pending.pop(key, None)
+        if nicks is None or key not in self._members:
+            return
+        current = set(irc_lower(nick) for nick in nicks)
+        for nick in list(self._members[key]):
+            if nick not in current:
+                self._remove(nick, key)
+        for nick in nicks:
+            self._add(nick, key)
+
+    def _who_reply(self, channel, user, host, nick):
+        """Records a member and their host from a WHO reply (352)."""
+        key = irc_lower(channel)
+        if key in self._members:
+            self._add(nick, key)
+            self._hosts[irc_lower(nick)] = '%s@%s' % (user, host)
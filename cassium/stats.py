@@ -0,0 +1,143 @@
+from collections import deque
+import logging
+from threading import Lock
+import time
+from types import GeneratorType
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+__all__ = ['Profiler']
+
+class HandlerStats(object):
+    """Timing statistics for one plugin's handler for one signal type."""
+
+    def __init__(self, name, signaltype, samples):
+        self.name = name
+        self.signaltype = signaltype
+        # The most recent latencies, for percentiles
+        self.samples = deque(maxlen=samples)
+        # Blocking handlers record from the thread pool
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.errors = 0
+            self.total = 0.
+            self.slowest = 0.
+            self.samples.clear()
+
+    def record(self, elapsed, error):
+        with self.lock:
+            self.calls += 1
+            self.total += elapsed
+            self.slowest = max(self.slowest, elapsed)
+            self.samples.append(elapsed)
+            if error:
+                self.errors += 1
+
+    def percentile(self, fraction):
+        """Returns the given percentile of the recent latencies."""
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def summary(self):
+        """Returns a one-line summary of the statistics."""
+        return ('%s.%s: %d calls, %.3fs total, p50 %.1fms, p99 %.1fms, '
+            'max %.1fms, %d errors' % (self.name, self.signaltype,
+                self.calls, self.total, self.percentile(.5) * 1000,
+                self.percentile(.99) * 1000, self.slowest * 1000,
+                self.errors))
+
+
+class Timed(object):
+    """
+    A signal handler wrapped to record its timing.
+
+    Handlers that return Deferreds are timed until the Deferred fires. The
+    wrapper carries the attributes Cassium looks for on handlers.
+    """
+
+    def __init__(self, profiler, stats, method):
+        self.profiler = profiler
+        self.stats = stats
+        self.method = method
+        self.__self__ = method.__self__
+        self.__name__ = method.__name__
+        self.blocking = getattr(method, 'blocking', False)
+        self.timeout = getattr(method, 'timeout', None)
+
+    def __call__(self, *args):
+        started = time.time()
+        try:
+            result = self.method(*args)
+        except Exception:
+            self.profiler.record(self.stats, started, True)
+            raise
+        # Drive bare generators here so their whole run is timed
+        if isinstance(result, GeneratorType):
+            result = defer.inlineCallbacks(lambda gen=result: gen)()
+        if isinstance(result, defer.Deferred):
+            result.addBoth(self.done, started)
+        else:
+            self.profiler.record(self.stats, started, False)
+        return result
+
+    def done(self, result, started):
+        self.profiler.record(self.stats, started,
+            isinstance(result, Failure))
+        return result
+
+
+class Profiler(object):
+    """
+    Records call counts, latencies and errors of plugin signal handlers.
+
+    Handlers are wrapped when the dispatch table is built, so nothing is
+    recorded, or costs anything, unless profiling is enabled. Calls slower
+    than `slow` seconds are logged as warnings.
+    """
+
+    def __init__(self, slow=.5, samples=1000):
+        self.slow = slow
+        self.samples = samples
+        self.log = logging.getLogger(__name__)
+        self.stats = {}     # (plugin fqn, signal type) -> HandlerStats
+
+    def wrap(self, name, signaltype, method):
+        """Returns a version of a handler that records its timing."""
+        stats = self.stats.get((name, signaltype))
+        if stats is None:
+            stats = self.stats[(name, signaltype)] = HandlerStats(name,
+                signaltype, self.samples)
+        return Timed(self, stats, method)
+
+    def record(self, stats, started, error):
+        elapsed = time.time() - started
+        stats.record(elapsed, error)
+        if elapsed > self.slow:
+            self.log.warn('slow call: %s.%s took %.3fs' %
+                (stats.name, stats.signaltype, elapsed))
+
+    def top(self, count=None):
+        """Returns called handlers' statistics by descending total time."""
+        ranked = sorted([stats for stats in self.stats.values()
+            if stats.calls], key=lambda stats: stats.total, reverse=True)
+        return ranked[:count]
+
+    def reset(self):
+        """Discards all recorded statistics."""
+        for stats in self.stats.values():
+            stats.reset()
+
+    def dump(self, path):
+        """Writes a summary of every handler's statistics to a file."""
+        with open(path, 'w') as f:
+            f.write('# %s\n' % time.strftime('%Y-%m-%d %H:%M:%S'))
+            for stats in self.top():
+                f.write(stats.summary() + '\n')
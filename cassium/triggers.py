@@ -0,0 +1,94 @@
+import re
+
+__all__ = ['TriggerIndex']
+
+# Marks the end of a prefix in the trie; never a valid character
+END = None
+
+# Flags of a pattern compiled without any, which are safe to combine
+DEFAULT_FLAGS = re.compile('').flags
+
+def combinable(pattern):
+    """
+    Returns whether a pattern can be joined with others into one regex.
+
+    Patterns with flags can't be, and neither can patterns with groups, as
+    joining renumbers them (breaking backreferences) and repeats any names.
+    """
+    return pattern.flags == DEFAULT_FLAGS and pattern.groups == 0
+
+class TriggerIndex(object):
+    """
+    An index of the message triggers declared by plugins.
+
+    The index is built from a list of (plugin, handler) pairs in dispatch
+    order. Plugins that declare no triggers receive every message; the rest
+    only receive messages matching one of their commands, prefixes or
+    patterns. match() always returns handlers in their original order.
+    """
+
+    def __init__(self, entries):
+        self.handlers = [handler for plugin, handler in entries]
+        self.always = []        # Handlers for plugins without triggers
+        self.always_orders = set()
+        self.commands = {}      # First word -> set of orders
+        self.trie = {}          # Nested dicts keyed on characters
+        # (compiled pattern, order), for the patterns searched on their own
+        # and those first searched for together
+        self.patterns = []
+        self.combinable = []
+        for order, (plugin, handler) in enumerate(entries):
+            commands = plugin.commands or ()
+            prefixes = plugin.prefixes or ()
+            patterns = plugin.patterns or ()
+            # An empty prefix matches everything
+            if not (commands or prefixes or patterns) or '' in prefixes:
+                self.always.append(handler)
+                self.always_orders.add(order)
+                continue
+            for command in commands:
+                self.commands.setdefault(command, set()).add(order)
+            for prefix in prefixes:
+                node = self.trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node.setdefault(END, set()).add(order)
+            for pattern in patterns:
+                if not hasattr(pattern, 'search'):
+                    pattern = re.compile(pattern)
+                if combinable(pattern):
+                    self.combinable.append((pattern, order))
+                else:
+                    self.patterns.append((pattern, order))
+        # One search tells whether any of the combinable patterns match
+        self.combined = None
+        if self.combinable:
+            try:
+                self.combined = re.compile('|'.join('(?:%s)' % pattern.pattern
+                    for pattern, order in self.combinable))
+            except (re.error, OverflowError, AssertionError):
+                self.patterns.extend(self.combinable)
+                self.combinable = []
+
+    def match(self, message):
+        """Returns the handlers that should receive the given message."""
+        matched = self.commands.get(message.split(' ', 1)[0])
+        matched = set(matched) if matched else set()
+        # Walk the trie, collecting every prefix that ends along the way
+        node = self.trie
+        for char in message:
+            node = node.get(char)
+            if node is None:
+                break
+            if END in node:
+                matched.update(node[END])
+        patterns = self.patterns
+        if self.combined is not None and self.combined.search(message):
+            patterns = self.combinable + patterns
+        for pattern, order in patterns:
+            if order not in matched and pattern.search(message):
+                matched.add(order)
+        if not matched:
+            return self.always
+        matched.update(self.always_orders)
+        return [self.handlers[order] for order in sorted(matched)]
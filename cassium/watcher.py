@@ -0,0 +1,84 @@
+import logging
+import os
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+except ImportError:
+    inotify = None
+
+__all__ = ['PluginWatcher']
+
+# Changes that may affect a plugin module
+MASK = 0
+if inotify is not None:
+    MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE |
+        inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO)
+
+class PluginWatcher(object):
+    """
+    Reloads a PluginManager's modules as their files change.
+
+    Where inotify is available and plugins are loaded from a directory, the
+    directory is watched and a rescan follows `settle` seconds after the last
+    change, so a burst of writes from an editor or a deploy reloads once.
+    Otherwise the files are checked every `interval` seconds. Either way the
+    rescan runs in the reactor, between events.
+    """
+
+    def __init__(self, manager, interval=2., settle=.5, clock=reactor):
+        self.manager = manager
+        self.interval = interval
+        self.settle = settle
+        self.clock = clock
+        self.log = logging.getLogger(__name__)
+        self.notifier = None
+        self.poller = None
+        self.call = None
+
+    def start(self):
+        directory = getattr(self.manager.config, 'plugin_dir', 'plugins')
+        if (inotify is not None and
+                not hasattr(self.manager.config, 'plugins')):
+            try:
+                self.notifier = inotify.INotify()
+                self.notifier.startReading()
+                self.notifier.watch(FilePath(os.path.abspath(directory)),
+                    mask=MASK, autoAdd=True, recursive=True,
+                    callbacks=[self.changed])
+                self.log.info('watching %s with inotify' % directory)
+                return
+            except Exception:
+                self.log.exception('inotify is unavailable, polling instead')
+                self.stop()
+        self.poller = LoopingCall(self.rescan)
+        self.poller.clock = self.clock
+        self.poller.start(self.interval, now=False)
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+        if self.poller is not None and self.poller.running:
+            self.poller.stop()
+        self.poller = None
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def changed(self, ignored, path, mask):
+        """Schedules a rescan once changes to .py files settle."""
+        if not path.basename().endswith('.py'):
+            return
+        if self.call is not None and self.call.active():
+            self.call.reset(self.settle)
+        else:
+            self.call = self.clock.callLater(self.settle, self.rescan)
+
+    def rescan(self):
+        self.call = None
+        loaded = self.manager.rescan()
+        if loaded:
+            self.log.info('reloaded ' + ', '.join(loaded))
@@ -0,0 +1,437 @@
+"""
+Runs plugins in worker processes, so CPU-heavy plugins can use other cores.
+
+Plugins in a worker get queries without `state` or `history`, which only
+exist in the main process, so plugins that need them declare `in_workers =
+False` and are refused by workers. Their scheduled jobs are kept in the
+worker, but each one is fired through the main process, which calls it back
+in the worker once connected to the job's network. Responses, query fields
+and job arguments must be marshallable.
+
+The main process and each worker exchange marshalled tuples framed as
+netstrings over the worker's stdin and stdout. The main process sends
+
+    ('call', id, plugin fqn, signal type, network, default target,
+        query fields, channels)
+    ('save', plugin fqn)
+
+where a call of signal type 'job' carries the job's method name and
+arguments as the query fields `job` and `args`, and the worker replies with
+
+    ('manifest', [plugin description, ...])
+    ('result', id, response contents)
+    ('error', id, message)
+    ('job', plugin fqn, method name, args, network)
+
+A worker is started with
+
+    python -c "from cassium.worker import main; main()" module...
+
+where each plugin description is as returned by manager.describe().
+"""
+import logging
+import marshal
+import os
+import sys
+from types import GeneratorType
+
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.protocols.basic import NetstringReceiver
+from zope.interface import implementer
+
+from lazy import StandIn
+from manager import PluginManager, describe
+from plugin import *
+from plugin import MISSING
+from scheduler import JobCall
+
+__all__ = ['RemoteError', 'RemotePlugin', 'WorkerPool', 'main']
+
+# The command that starts a worker
+ENTRY = 'from cassium.worker import main; main()'
+# Query fields that are sent separately, or not at all
+QUERY_BASE = ('channels', 'type', 'network', 'state', 'history')
+
+class Framer(NetstringReceiver):
+    """Frames messages as netstrings."""
+
+    # Long enough for the largest Response
+    MAX_LENGTH = 1 << 24
+
+
+def query_fields(query):
+    """
+    Gets the fields a Query was created with, as a dict. Attributes in its
+    __dict__ that can't be marshalled are left out.
+    """
+    fields = {}
+    for cls in type(query).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name[0] != '_' and name not in QUERY_BASE:
+                value = getattr(query, name, MISSING)
+                if value is not MISSING:
+                    fields[name] = value
+    for name, value in getattr(query, '__dict__', {}).items():
+        if name[0] != '_':
+            try:
+                marshal.dumps(value)
+            except ValueError:
+                continue
+            fields[name] = value
+    return fields
+
+
+class RemoteError(Exception):
+    """An error raised by a plugin in a worker, or by the worker dying."""
+
+
+class RemoteHandler(object):
+    """
+    A plugin's signal handler in a worker process.
+
+    Calling it sends the Query to the worker and returns a Deferred that
+    fires once the worker's Response has been merged into the given one. It
+    returns None while the worker is down.
+    """
+
+    blocking = False
+
+    def __init__(self, plugin, signaltype, blocking, timeout):
+        self.__self__ = plugin
+        self.__name__ = signaltype
+        self.timeout = timeout
+
+    def __call__(self, query, response):
+        return self.__self__.worker.call(self.__self__.fqn(), self.__name__,
+            query, response)
+
+
+class RemoteJob(object):
+    """
+    A scheduled job of a plugin in a worker, passed to Cassium like a
+    handler. Calling it runs the job in the worker.
+    """
+
+    blocking = False
+    timeout = None
+
+    def __init__(self, plugin, name, args):
+        self.__self__ = plugin
+        self.__name__ = name
+        self.args = args
+
+    def __call__(self, query, response):
+        return self.__self__.worker.call(self.__self__.fqn(), 'job', query,
+            response, {'job': self.__name__, 'args': self.args})
+
+
+class RemotePlugin(StandIn):
+    """
+    Stands in for a plugin hosted by a worker, with a RemoteHandler for each
+    signal the plugin handles. Its data lives in the worker.
+    """
+
+    handler = RemoteHandler
+
+    def __init__(self, worker, *description):
+        self.worker = worker
+        StandIn.__init__(self, *description)
+
+    def save(self):
+        """Asks the worker to save the plugin's data."""
+        self.worker.send(('save', self.name))
+        return 0
+
+
+class Worker(protocol.ProcessProtocol):
+    """
+    Starts a worker process hosting the plugins of some modules, and relays
+    calls to it.
+    """
+
+    def __init__(self, pool, number, modules):
+        self.pool = pool
+        self.number = number
+        self.modules = list(modules)
+        self.log = logging.getLogger('%s.%d' % (__name__, number))
+        self.framer = None
+        self.ready = False
+        self.pending = {}   # Call id -> (Deferred, Response)
+        self.next_id = 0
+        self.ended = None
+        self.delay = pool.restart_delay
+        self.restarting = False
+
+    def start(self):
+        if self.pool.stopping:
+            return
+        self.ended = defer.Deferred()
+        reactor.spawnProcess(self, sys.executable,
+            [sys.executable, '-c', ENTRY] + self.modules, env=os.environ,
+            childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def stop(self):
+        """Closes the worker's stdin, which makes it save and exit."""
+        if self.transport is not None and self.ended is not None:
+            self.transport.closeStdin()
+            return self.ended
+        return defer.succeed(None)
+
+    def restart(self):
+        """Stops the worker and starts it again, reloading its modules."""
+        if self.transport is not None:
+            self.restarting = True
+            self.transport.closeStdin()
+
+    def connectionMade(self):
+        self.framer = Framer()
+        self.framer.stringReceived = self.received
+        self.framer.makeConnection(self.transport)
+
+    def outReceived(self, data):
+        self.framer.dataReceived(data)
+
+    def send(self, message):
+        if self.ready:
+            self.framer.sendString(marshal.dumps(message))
+
+    def call(self, name, signaltype, query, response, fields=None):
+        if not self.ready:
+            return None
+        self.next_id += 1
+        all_fields = query_fields(query)
+        if fields:
+            all_fields.update(fields)
+        self.framer.sendString(marshal.dumps(('call', self.next_id, name,
+            signaltype, query.network, response._defaulttarget,
+            all_fields, query.channels)))
+        d = defer.Deferred()
+        self.pending[self.next_id] = (d, response)
+        return d
+
+    def received(self, data):
+        message = marshal.loads(data)
+        kind = message[0]
+        if kind == 'manifest':
+            self.ready = True
+            self.delay = self.pool.restart_delay
+            self.pool.manager.load_remote_plugins(self, [RemotePlugin(self,
+                *entry) for entry in message[1]])
+            return
+        if kind == 'job':
+            self.job(*message[1:])
+            return
+        d, response = self.pending.pop(message[1], (None, None))
+        if d is None:
+            return
+        if kind == 'result':
+            forked = response._fork()
+            forked.__dict__.update(message[2])
+            response._merge(forked)
+            d.callback(None)
+        else:
+            d.errback(RemoteError(message[2]))
+
+    def job(self, name, method, args, network):
+        """Fires a job that came due in the worker."""
+        manager = self.pool.manager
+        i = manager.index.get(name)
+        if i is None:
+            return
+        call = RemoteJob(manager.plugins[i], method, args)
+        if not manager.run_call(call, network):
+            manager.scheduler.defer_call(call, network)
+
+    def processEnded(self, reason):
+        self.ready = False
+        self.transport = None
+        pending, self.pending = self.pending, {}
+        for d, response in pending.values():
+            d.errback(RemoteError('worker %d exited' % self.number))
+        ended, self.ended = self.ended, None
+        ended.callback(None)
+        if self.restarting:
+            self.restarting = False
+            self.log.info('restarting worker %d' % self.number)
+            self.start()
+        elif not self.pool.stopping:
+            self.log.error('worker %d exited (%s); restarting in %.0fs' %
+                (self.number, reason.getErrorMessage(), self.delay))
+            reactor.callLater(self.delay, self.start)
+            # Back off while the worker keeps dying
+            self.delay = min(self.delay * 2, 300.)
+
+
+class WorkerPool(object):
+    """
+    The worker processes for a PluginManager.
+
+    `assignments` lists the plugin modules to host in each worker. A worker
+    that exits is restarted after `restart_delay` seconds, doubling while it
+    keeps exiting; calls it was handling fail, and signals are not sent to
+    its plugins until it is back.
+    """
+
+    def __init__(self, manager, assignments, restart_delay=1.):
+        self.manager = manager
+        self.restart_delay = restart_delay
+        self.stopping = False
+        self.workers = [Worker(self, number, modules)
+            for number, modules in enumerate(assignments)]
+        # The worker hosting each module
+        self.owners = dict((module, worker) for worker in self.workers
+            for module in worker.modules)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """Stops every worker, returning a Deferred that fires once done."""
+        self.stopping = True
+        return defer.DeferredList([worker.stop() for worker in self.workers])
+
+
+@implementer(IHalfCloseableProtocol)
+class WorkerHost(Framer):
+    """
+    Hosts plugins in a worker process, serving calls on stdin.
+
+    Once stdin is closed, the calls in progress are finished, the plugins
+    are saved and the worker exits.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        manager.host = self
+        self.log = logging.getLogger(__name__)
+        self.busy = set()   # Ids of calls in progress
+        self.closing = False
+
+    def connectionMade(self):
+        refused = [plugin for plugin in self.manager.plugins
+            if not plugin.in_workers]
+        for plugin in refused:
+            self.log.error('%s can\'t run in a worker; not loading it' %
+                plugin.fqn())
+        self.manager.remove_plugins(refused)
+        manifest = [describe(plugin) for plugin in self.manager.plugins]
+        self.sendString(marshal.dumps(('manifest', manifest)))
+
+    def stringReceived(self, data):
+        message = marshal.loads(data)
+        if message[0] == 'save':
+            self.plugin(message[1]).save()
+        elif message[0] == 'call':
+            self.call(*message[1:])
+
+    def plugin(self, name):
+        return self.manager.plugins[self.manager.index[name]]
+
+    def call(self, id, name, signaltype, network, target, fields, channels):
+        self.busy.add(id)
+        response = Response(target)
+        try:
+            if signaltype == 'job':
+                method = JobCall(getattr(self.plugin(name),
+                    fields.pop('job')), tuple(fields.pop('args')))
+            else:
+                method = getattr(self.plugin(name), signaltype)
+            query = Query(channels, signaltype, **fields)
+            query.network = network
+            if getattr(method, 'blocking', False):
+                result = threads.deferToThread(method, query, response)
+            else:
+                result = method(query, response)
+                if isinstance(result, GeneratorType):
+                    result = defer.inlineCallbacks(lambda gen=result: gen)()
+        except Exception:
+            self.failed(id, name, signaltype)
+            return
+        if isinstance(result, defer.Deferred):
+            result.addCallbacks(lambda ignored: self.reply(id, response),
+                lambda failure: self.failed(id, name, signaltype, failure))
+        else:
+            self.reply(id, response)
+
+    def reply(self, id, response):
+        contents = vars(response)
+        del contents['_defaulttarget']
+        try:
+            data = marshal.dumps(('result', id, contents))
+        except ValueError:
+            data = marshal.dumps(('error', id,
+                'ValueError: the response can\'t be sent from a worker'))
+        self.done(id, data)
+
+    def failed(self, id, name, signaltype, failure=None):
+        if failure is None:
+            exc_type, exc = sys.exc_info()[:2]
+            self.log.exception('%s.%s failed' % (name, signaltype))
+        else:
+            exc_type, exc = failure.type, failure.value
+            self.log.error('%s.%s failed\n%s' % (name, signaltype,
+                failure.getTraceback()))
+        self.done(id, marshal.dumps(('error', id,
+            '%s: %s' % (exc_type.__name__, exc))))
+
+    def done(self, id, data):
+        self.sendString(data)
+        self.busy.discard(id)
+        if self.closing and not self.busy:
+            self.close()
+
+    def readConnectionLost(self):
+        self.closing = True
+        if not self.busy:
+            self.close()
+
+    def writeConnectionLost(self):
+        # Nobody is left to reply to
+        self.busy.clear()
+        self.readConnectionLost()
+
+    def close(self):
+        self.manager.save()
+        # Exits once everything written has been flushed
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+class WorkerManager(PluginManager):
+    """The PluginManager of a worker, which fires jobs in the main process."""
+
+    host = None
+
+    def run_job(self, plugin, job):
+        when, interval, name, args, network = job
+        if not hasattr(getattr(plugin, name, None), '__call__'):
+            raise AttributeError(name)
+        self.host.sendString(marshal.dumps(('job', plugin.fqn(), name,
+            args, network)))
+        return True
+
+
+class WorkerConfig(object):
+    """The configuration of a worker's PluginManager."""
+
+    def __init__(self, modules):
+        self.plugins = modules
+
+
+def main():
+    """Runs a worker hosting the plugins of the modules named in argv."""
+    from twisted.internet import stdio
+    # stdout carries frames, so keep anything printed off it
+    sys.stdout = sys.stderr
+    logging.basicConfig(level=logging.INFO,
+        format='worker %d: %%(name)s: [%%(levelname)s] %%(message)s' %
+            os.getpid())
+    manager = WorkerManager(WorkerConfig(sys.argv[1:]))
+    stdio.StandardIO(WorkerHost(manager))
+    reactor.run()
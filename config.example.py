@@ -9,3 +9,106 @@ channels = [
     '#cassium',
 ]
 admins = []
+
+# To join several networks from one process, list them here. Each network's
+# settings override the ones above, and every network shares one set of
+# plugins. A network that can't be reached is retried every retry_delay
+# seconds (60 unless set) rather than stopping the bot; with a single
+# network, Cassium stops unless retry_delay is set.
+# networks = {
+#     'example': {'server': 'irc.example.com', 'port': 6667},
+#     'other': {'server': 'irc.example.org', 'port': 6667,
+#         'nick': 'Cassium2', 'channels': ['#cassium', '#other']},
+# }
+# retry_delay = 60.
+
+# Plugins are loaded from every module under plugin_dir, unless plugins
+# lists the modules (or individual plugins) to load instead
+plugin_dir = 'plugins'
+# plugins = ['plugins.hello', 'plugins.log']
+# Plugin modules listed here run in worker processes instead, one list of
+# modules per worker, so CPU-heavy plugins don't hold up the others. A worker
+# that dies is restarted after worker_restart_delay seconds, backing off
+# while it keeps dying. Plugins that need channel state or history, such as
+# Log and Grep, can't run in workers (see cassium/worker.py).
+# workers = [
+#     ['plugins.hello'],
+# ]
+# worker_restart_delay = 1.
+
+# Reload plugin modules as soon as their files change, rather than with
+# `import or `rescan. Changes are noticed through inotify where available, or
+# by checking every watch_interval seconds.
+watch_plugins = False
+watch_interval = 2.
+
+# Start without importing plugin modules that haven't changed since the last
+# run, using the plugins' triggers and handlers cached in manifest_file.
+# Each such module is imported when one of its plugins is first used, and
+# with lazy_background set, all of them are imported one at a time once
+# Cassium has signed on.
+lazy_startup = False
+lazy_background = True
+manifest_file = 'save/manifest.pck'
+
+# The tick signal is sent every tick_interval seconds, once however many
+# networks Cassium is on (None disables it)
+tick_interval = 10.
+
+# Ask for the user and host of everyone in a channel on joining it, for
+# query.state.host()
+who_on_join = True
+
+# Everything said in channels is indexed for full-text search in this
+# sqlite database, available to plugins as query.history (None disables it)
+history_file = 'save/history.db'
+
+# Blocking plugin handlers run in a thread pool of this size, and are
+# reported as failed if they take longer than plugin_timeout seconds
+thread_pool_size = 10
+plugin_timeout = 30.
+
+# Outgoing lines are limited to send_rate per second (in bursts of
+# send_burst) overall and send_target_rate per second (in bursts of
+# send_target_burst) per channel or user. Queued lines to the same target
+# are joined with send_separator (None disables this), and at most
+# send_queue_limit lines are queued per target.
+send_rate = 1.
+send_burst = 5
+send_target_rate = .5
+send_target_burst = 3
+send_queue_limit = 100
+send_separator = ' | '
+
+# Incoming messages and actions are signalled at most flood_rate per second
+# (in bursts of flood_burst) from each host, and flood_channel_rate per
+# second (in bursts of flood_channel_burst) in each channel; the rest are
+# dropped, and a host that floods is ignored for flood_ignore_time seconds.
+# Limits are kept for the flood_limit most recently seen hosts and channels.
+# Messages are also dropped while more than flood_backlog lines are waiting
+# to be sent. Admins are never limited, and a rate of None disables a limit.
+flood_rate = 2.
+flood_burst = 10
+flood_channel_rate = 20.
+flood_channel_burst = 50
+flood_ignore_time = 60.
+flood_limit = 10000
+flood_backlog = 500
+
+# Beyond mass_rate joins or quits per second (in bursts of mass_burst), as
+# in a netsplit, they're gathered for mass_window seconds and signalled as
+# one massjoin or massquit per channel (None disables this)
+mass_rate = 5.
+mass_burst = 20
+mass_window = 1.
+
+# Plugin data is saved in the background every autosave_interval seconds
+# (None disables this)
+autosave_interval = 300.
+
+# Record call counts, latencies and errors for every plugin handler, viewable
+# with `stats, and warn about calls slower than profile_slow seconds.
+# `stats dump writes them to stats_file.
+profile = False
+profile_slow = .5
+stats_file = 'save/stats.txt'
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+Load tests Cassium end to end against a local IRC server.
+
+Starts cassium.ircd's server on the loopback interface, connects Cassium to
+it through CassiumFactory, and connects simulated users that chat across
+many channels. Users send `!hello` now and then, and the time until
+Cassium's reply arrives is reported along with throughput and what
+Cassium's flood protection dropped. Scenarios add a flooder or a netsplit
+to the background chatter, and a script can drive the users instead:
+
+    ./loadtest.py --users 200 --channels 20 --rate 500 --duration 30
+    ./loadtest.py --scenario netsplit --plugins plugins.hello,plugins.log
+    ./loadtest.py --script session.txt
+
+A script has one line per message, `seconds nick raw IRC line`, e.g.
+`1.5 user3 PRIVMSG #chan1 :!hello`. Users are named user0, user1 and so
+on, and times are counted from when every user has joined. With --serve,
+only the server is run, for a Cassium started separately.
+"""
+from collections import deque
+import logging
+from optparse import OptionParser
+import random
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.task import LoopingCall
+from twisted.words.protocols.irc import IRCClient
+
+from cassium.cassium import CassiumFactory
+from cassium.ircd import IRCServer
+
+WORDS = ('the quick brown fox jumps over the lazy dog hello world foo bar '
+    'baz lorem ipsum dolor sit amet').split()
+
+class LoadConfig(object):
+    """A stand-in for the configuration module."""
+
+    nick = 'Cassium'
+    realname = 'A Cassium IRC Bot'
+    admins = []
+    channels = []
+    log_verbosity = 'WARNING'
+    log_format = '%(name)s: [%(levelname)s] %(message)s'
+    tick_interval = None
+    autosave_interval = None
+    history_file = None
+    # Measure Cassium rather than the send queue's rate limits
+    send_rate = 10000.
+    send_burst = 10000
+    send_target_rate = 10000.
+    send_target_burst = 10000
+
+
+class LoadClient(IRCClient):
+    """A simulated user, which joins its channels and times replies."""
+
+    def signedOn(self):
+        for channel in self.factory.channels:
+            self.join(channel)
+
+    def joined(self, channel):
+        self.factory.joined(self, channel)
+
+    def privmsg(self, user, channel, message):
+        if user.split('!', 1)[0] == self.factory.test.bot:
+            self.factory.test.replied(self, channel, message)
+
+    def lineReceived(self, line):
+        self.factory.test.received += 1
+        IRCClient.lineReceived(self, line)
+
+
+class LoadClientFactory(protocol.ClientFactory):
+    """Connects one simulated user, reconnecting after a netsplit."""
+
+    protocol = LoadClient
+
+    def __init__(self, test, nick, channels):
+        self.test = test
+        self.nick = nick
+        self.channels = channels
+        self.client = None
+        self.pending = set(channels)    # Channels not joined yet
+
+    def buildProtocol(self, addr):
+        client = protocol.ClientFactory.buildProtocol(self, addr)
+        client.nickname = self.nick
+        client.realname = self.nick
+        client.lineRate = None
+        self.client = client
+        return client
+
+    def joined(self, client, channel):
+        self.pending.discard(channel)
+        if not self.pending:
+            self.test.ready(self)
+
+    def clientConnectionLost(self, connector, reason):
+        self.client = None
+
+    def clientConnectionFailed(self, connector, reason):
+        self.test.log.error('%s could not connect: %s' %
+            (self.nick, reason.getErrorMessage()))
+
+
+class LoadTest(object):
+    """Drives simulated users and collects reply latencies."""
+
+    def __init__(self, options, port):
+        self.options = options
+        self.port = port
+        self.bot = LoadConfig.nick
+        self.log = logging.getLogger('loadtest')
+        self.rng = random.Random(options.seed)
+        self.channels = ['#chan%d' % i for i in range(options.channels)]
+        self.users = []
+        self.waiting = set()
+        self.started = defer.Deferred()
+        # (channel, nick) -> deque of times !hello was sent
+        self.pending = {}
+        self.latencies = []
+        # Counters
+        self.sent = 0
+        self.commands = 0
+        self.received = 0
+        self.flooded = 0
+
+    def connect(self):
+        """Connects every user; started fires once they've all joined."""
+        for i in range(self.options.users):
+            count = min(len(self.channels), self.options.per_user)
+            channels = self.rng.sample(self.channels, count)
+            factory = LoadClientFactory(self, 'user%d' % i, channels)
+            self.users.append(factory)
+            self.waiting.add(factory)
+            reactor.connectTCP('127.0.0.1', self.port, factory)
+        return self.started
+
+    def ready(self, factory):
+        if factory in self.waiting:
+            self.waiting.discard(factory)
+            if not self.waiting:
+                self.started.callback(None)
+
+    def say(self, factory, channel, text):
+        if factory.client is None:
+            return
+        if text == '!hello':
+            self.pending.setdefault((channel, factory.nick),
+                deque()).append(time.time())
+            self.commands += 1
+        factory.client.msg(channel, text)
+        self.sent += 1
+
+    def replied(self, client, channel, message):
+        if message != 'Hello, %s!' % client.nickname:
+            return
+        sent = self.pending.get((channel, client.nickname))
+        if sent:
+            self.latencies.append(time.time() - sent.popleft())
+
+    def chatter(self, rate):
+        """Sends `rate` messages per second from random users."""
+        step = .01
+        carry = [0.]
+        def tick():
+            carry[0] += rate * step
+            while carry[0] >= 1:
+                carry[0] -= 1
+                factory = self.rng.choice(self.users)
+                channel = self.rng.choice(factory.channels)
+                if self.rng.random() < self.options.commands:
+                    text = '!hello'
+                else:
+                    text = ' '.join(self.rng.choice(WORDS)
+                        for i in range(self.rng.randint(1, 12)))
+                self.say(factory, channel, text)
+        timer = LoopingCall(tick)
+        timer.start(step)
+        return timer
+
+    def flood(self):
+        """Floods one channel with !hello from one user."""
+        factory = self.users[0]
+        channel = factory.channels[0]
+        def tick():
+            if factory.client is None:
+                return
+            for i in range(10):
+                factory.client.msg(channel, '!hello')
+                self.flooded += 1
+        timer = LoopingCall(tick)
+        timer.start(10. / self.options.flood_rate)
+        return timer
+
+    def netsplit(self):
+        """Disconnects half of the users at once, and reconnects them."""
+        split = self.users[:len(self.users) // 2]
+        for factory in split:
+            if factory.client is not None:
+                factory.client.quit('irc.cassium.test split.cassium.test')
+        def rejoin():
+            for factory in split:
+                factory.pending = set(factory.channels)
+                reactor.connectTCP('127.0.0.1', self.port, factory)
+        reactor.callLater(self.options.duration / 4., rejoin)
+
+    def play(self, path):
+        """Sends the lines of a script at their times."""
+        users = dict((factory.nick, factory) for factory in self.users)
+        last = 0.
+        with open(path) as f:
+            for number, text in enumerate(f):
+                text = text.strip()
+                if not text or text.startswith('#'):
+                    continue
+                seconds, nick, raw = text.split(' ', 2)
+                factory = users.get(nick)
+                if factory is None:
+                    raise SystemExit('%s:%d: no such user %s' %
+                        (path, number + 1, nick))
+                last = max(last, float(seconds))
+                reactor.callLater(float(seconds), self.send_raw, factory,
+                    raw)
+        return last
+
+    def send_raw(self, factory, raw):
+        if factory.client is None:
+            return
+        words = raw.split(' ', 2)
+        if words[0].upper() == 'PRIVMSG' and len(words) == 3:
+            self.say(factory, words[1], words[2][1:])
+        else:
+            factory.client.sendLine(raw)
+            self.sent += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def memory():
+    """Returns the peak resident set size in KB, where available."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def report(test, server, cassium, elapsed):
+    latencies = sorted(test.latencies)
+    print('%d messages sent in %.1fs (%.0f/sec), %d lines received' %
+        (test.sent, elapsed, test.sent / elapsed, test.received))
+    if test.flooded:
+        print('%d messages flooded' % test.flooded)
+    print('%d commands, %d replies (%.0f%%)' % (test.commands,
+        len(latencies), 100. * len(latencies) / (test.commands or 1)))
+    if latencies:
+        print('reply latency: mean %.1fms, p50 %.1fms, p90 %.1fms, '
+            'p99 %.1fms, max %.1fms' % (
+                1000 * sum(latencies) / len(latencies),
+                1000 * percentile(latencies, .5),
+                1000 * percentile(latencies, .9),
+                1000 * percentile(latencies, .99),
+                1000 * latencies[-1]))
+    print('server: %(users)d users, %(channels)d channels, %(received)d '
+        'lines received, %(sent)d sent' % server.stats())
+    if cassium is not None:
+        print('ingress: %(admitted)d admitted, %(dropped)d dropped, '
+            '%(shed)d shed, %(batched)d batched, ignoring %(ignoring)d' %
+            cassium.ingress.stats())
+        print('send queue: %(depth)d queued, %(sent)d sent, %(dropped)d '
+            'dropped' % cassium.outbound.stats())
+    print('peak memory: %d KB' % memory())
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=0,
+        help='port for the server (default: any free port, or 6667 with '
+            '--serve)')
+    parser.add_option('--serve', action='store_true',
+        help='only run the server')
+    parser.add_option('-u', '--users', type='int', default=100,
+        help='number of simulated users')
+    parser.add_option('-c', '--channels', type='int', default=10,
+        help='number of channels')
+    parser.add_option('--per-user', type='int', default=3,
+        help='number of channels each user joins')
+    parser.add_option('-r', '--rate', type='float', default=100.,
+        help='messages per second from all users')
+    parser.add_option('--commands', type='float', default=.05,
+        help='fraction of messages that are !hello')
+    parser.add_option('-d', '--duration', type='float', default=10.,
+        help='seconds to run for')
+    parser.add_option('--scenario', choices=('chatter', 'flood',
+        'netsplit'), default='chatter',
+        help='chatter, flood (one user floods a channel) or netsplit (half '
+            'the users quit and rejoin)')
+    parser.add_option('--flood-rate', type='float', default=100.,
+        help='messages per second from the flooder')
+    parser.add_option('--script',
+        help='script of messages to send instead of chatter')
+    parser.add_option('-p', '--plugins', default='plugins.hello',
+        help='comma-separated plugin modules to load')
+    parser.add_option('--no-flood-limits', action='store_true',
+        help='disable Cassium\'s flood protection')
+    parser.add_option('-s', '--seed', type='int', default=0,
+        help='seed for simulated traffic')
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    server = IRCServer()
+    port = options.port or (6667 if options.serve else 0)
+    listener = reactor.listenTCP(port, server, interface='127.0.0.1')
+    if options.serve:
+        print('serving on 127.0.0.1:%d' % listener.getHost().port)
+        reactor.run()
+        return
+    port = listener.getHost().port
+
+    config = LoadConfig()
+    config.plugins = options.plugins.split(',')
+    test = LoadTest(options, port)
+    config.channels = test.channels
+    if options.no_flood_limits:
+        config.flood_rate = None
+        config.flood_channel_rate = None
+        config.flood_backlog = None
+        config.mass_rate = None
+    factory = CassiumFactory(config)
+    # Don't reconnect or stop the reactor on our behalf
+    factory.clientConnectionLost = lambda connector, reason: None
+    reactor.connectTCP('127.0.0.1', port, factory)
+
+    def start(ignored):
+        timers = []
+        duration = options.duration
+        if options.script:
+            duration = test.play(options.script) + 1.
+        else:
+            timers.append(test.chatter(options.rate))
+        if options.scenario == 'flood':
+            timers.append(test.flood())
+        elif options.scenario == 'netsplit':
+            reactor.callLater(duration / 4., test.netsplit)
+        started = time.time()
+        def stop():
+            for timer in timers:
+                timer.stop()
+            # Let the last replies arrive
+            reactor.callLater(1., finish, time.time() - started)
+        reactor.callLater(duration, stop)
+
+    def finish(elapsed):
+        connections = factory.manager.connections
+        report(test, server, connections[0] if connections else None,
+            elapsed)
+        reactor.stop()
+
+    def wait_for_bot():
+        # Users connect once Cassium has joined every channel
+        if len(server.channels) < len(test.channels):
+            reactor.callLater(.1, wait_for_bot)
+            return
+        test.connect().addCallback(start)
+
+    reactor.callLater(.1, wait_for_bot)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import sqlite3
+import time
+
+from twisted.internet.defer import inlineCallbacks
+
+from cassium.plugin import Plugin
+
+class Grep(Plugin):
+    """
+    Searches channel history, if history_file is configured.
+
+        !grep terms [in #channel]   the latest lines matching the terms
+        !last nick [in #channel]    the last thing nick said
+
+    Only channels the asker is in are searched: the current one by default,
+    or in a private message, every channel they share with Cassium. Lines
+    that are themselves searches are left out.
+    """
+
+    commands = ('!grep', '!last')
+    # Lines to reply with at most
+    limit = 3
+    # Needs query.history and query.state
+    in_workers = False
+
+    @inlineCallbacks
+    def msg(self, query, response):
+        if query.history is None or len(query.words) < 2:
+            return
+        if query.state is None:
+            # Without channel state, there's no telling who may see what
+            return
+        words = query.words[1:]
+        shared = query.state.channels_of(query.nick)
+        if query.channel[:1] in '#&':
+            channel = query.channel
+        else:
+            channel = sorted(shared)
+        if len(words) > 2 and words[-2] == 'in':
+            channel = words[-1]
+            words = words[:-2]
+            if not query.state.is_on(query.nick, channel):
+                response.msg('You aren\'t in %s.' % channel)
+                return
+        try:
+            if query.words[0] == '!grep':
+                lines = yield query.history.search(' '.join(words),
+                    channel=channel, network=query.network, limit=self.limit,
+                    skip=self.commands)
+            else:
+                lines = yield query.history.last(words[0], channel=channel,
+                    network=query.network, skip=self.commands)
+        except sqlite3.OperationalError:
+            response.msg('Bad search syntax.')
+            return
+        if not lines:
+            response.msg('Nothing found.')
+        for line in lines:
+            said = line.text
+            if line.type == 'action':
+                said = '* %s %s' % (line.nick, said)
+            elif line.type == 'topic':
+                said = '%s set the topic to: %s' % (line.nick, said)
+            else:
+                said = '<%s> %s' % (line.nick, said)
+            response.msg('[%s %s] %s' % (time.strftime('%Y-%m-%d %H:%M',
+                time.gmtime(line.time)), line.channel, said))
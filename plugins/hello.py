@@ -2,6 +2,8 @@ from cassium.plugin import Plugin
 
 class HelloWorld(Plugin):    
 
+    commands = ('!hello',)
+
     def msg(self, query, response):
         if query.message == '!hello':
             response.msg("Hello, %s!" % query.nick)
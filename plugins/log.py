@@ -1,62 +1,121 @@
 import logging
 
+from cassium.chatlog import get_chatlog
 from cassium.plugin import Plugin
 
 class Log(Plugin):
-    
+    """
+    Logs channel traffic to per-channel, per-day files under `directory`
+    (see cassium.chatlog), compressed if `compress` is set. With `echo` set
+    (the default), traffic is also logged to the console.
+    """
+
+    directory = 'logs'
+    compress = False
+    echo = True
+    transient = ('chatlog',)
+    # Quits and nick changes are logged to channels found in query.state
+    in_workers = False
+
+    def __init__(self):
+        Plugin.__init__(self)
+        self.chatlog = get_chatlog(self.directory, self.compress)
+
+    def _record(self, query, channel, type, user, *args):
+        self.chatlog.write(query.network, channel, type, user, *args)
+
+    def _record_user(self, query, nick, type, user, *args):
+        """Records an event in every channel a user is known to be in."""
+        if query.state is not None:
+            for channel in query.state.channels_of(nick):
+                self._record(query, channel, type, user, *args)
+
     def _log(self, channel, string):
-        if channel: channel += ': '
-        self.log.info(channel.rjust(16) + '-*- ' + string)
+        if self.echo:
+            if channel: channel += ': '
+            self.log.info(channel.rjust(16) + '-*- ' + string)
 
     def _logmsg(self, channel, string):
-        self.log.info((channel + ': ').rjust(16) + string)
-    
+        if self.echo:
+            self.log.info((channel + ': ').rjust(16) + string)
+
     def signedon(self, query, response):
         self._log('', 'Signed on')
 
     def ijoin(self, query, response):
+        self._record(query, query.channel, 'ijoin', None)
         self._log(query.channel, 'Joined %s' % (query.channel))
 
     def ileft(self, query, response):
+        self._record(query, query.channel, 'ileft', None)
         self._log(query.channel, 'Left %s' % (query.channel))
 
     def ikick(self, query, response):
+        self._record(query, query.channel, 'ikick', query.user,
+            query.message)
         self._log(query.channel,
             'Kicked from %s by %s (%s)' %
-            (query.channel, query.kicker, query.message))
+            (query.channel, query.user, query.message))
 
     def inick(self, query, response):
         self.nick(query, response)
 
     def join(self, query, response):
+        self._record(query, query.channel, 'join', query.user)
         self._log(query.channel,
             '%s joined %s' % (query.user, query.channel))
 
     def leave(self, query, response):
+        self._record(query, query.channel, 'leave', query.user)
         self._log(query.channel,
             '%s left %s' % (query.user, query.channel))
 
     def quit(self, query, response):
+        self._record_user(query, query.nick, 'quit', query.user,
+            query.message)
         self._log('',
             '%s quit (%s)' % (query.user, query.message))
 
+    def massjoin(self, query, response):
+        for nick in query.users:
+            self._record(query, query.channel, 'join', nick)
+        self._log(query.channel,
+            '%d users joined %s' % (len(query.users), query.channel))
+
+    def massquit(self, query, response):
+        channel = getattr(query, 'channel', None)
+        message = getattr(query, 'message', None)
+        if channel is not None:
+            for nick in query.users:
+                self._record(query, channel, 'quit', nick, message)
+        self._log(channel or '',
+            '%d users quit (%s)' % (len(query.users), message))
+
     def kick(self, query, response):
+        self._record(query, query.channel, 'kick', query.kicker,
+            query.kickee, query.message)
         self._log(query.channel,
             '%s kicked %s from %s (%s)' %
             (query.kicker, query.kickee, query.channel, query.message))
 
     def action(self, query, response):
+        self._record(query, query.channel, 'action', query.user,
+            query.message)
         self._log(query.channel,
             '%s %s' % (query.user, query.message))
 
     def topic(self, query, response):
+        self._record(query, query.channel, 'topic', query.user, query.topic)
         self._log(query.channel,
             '%s set %s\'s topic to: %s' %
             (query.user, query.channel, query.topic))
 
     def nick(self, query, response):
+        self._record_user(query, query.newname, 'nick', query.oldname,
+            query.newname)
         self._log('',
             '%s is now known as %s' % (query.oldname, query.newname))
 
     def msg(self, query, response):
+        self._record(query, query.channel, 'msg', query.user, query.message)
         self._logmsg(query.channel, '<%s> %s' % (query.nick, query.message))
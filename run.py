@@ -4,12 +4,24 @@ import sys
 
 from twisted.internet import reactor
 
-from cassium.cassium import Cassium, CassiumFactory
+from cassium.cassium import Cassium, CassiumFactory, NetworkConfig
 import config
 
 def main():
-    factory = CassiumFactory(config)
-    reactor.connectTCP('localhost', 6667, factory)
+    networks = getattr(config, 'networks', None)
+    if networks:
+        # The first network's factory loads the plugins for all of them
+        manager = None
+        for name, settings in sorted(networks.items()):
+            network_config = NetworkConfig(config, name, settings)
+            factory = CassiumFactory(network_config, manager)
+            manager = factory.manager
+            reactor.connectTCP(network_config.server, network_config.port,
+                factory)
+    else:
+        factory = CassiumFactory(config)
+        reactor.connectTCP(getattr(config, 'server', 'localhost'),
+            getattr(config, 'port', 6667), factory)
     reactor.run()
 
 if __name__ == "__main__":